@@ -1,16 +1,18 @@
+import importlib.util
+import time
 import streamlit as st
 from datetime import datetime
 
-# 作成したモジュールから関数をインポート
-from data_processor import load_data, process_data
-from html_generator import generate_html
+import instrumentation
 
-# CSV出力機能をインポート
-try:
-    from gross_profit_metrics_exporter import create_gross_profit_metrics_export_interface
-    CSV_EXPORT_AVAILABLE = True
-except ImportError:
-    CSV_EXPORT_AVAILABLE = False
+# pandas を使う処理モジュール（data_processor など）は、最初の画面を早く表示するため
+# ファイルがアップロードされてから各ステージの中で読み込む
+
+# CSV出力機能の有無（モジュールの読み込みはタブを表示するときに行う）
+CSV_EXPORT_AVAILABLE = importlib.util.find_spec("gross_profit_metrics_exporter") is not None
+
+# バックグラウンド処理の進捗を確認する間隔（秒）
+JOB_POLL_SECONDS = 0.5
 
 # --- ページ設定 ---
 st.set_page_config(
@@ -19,6 +21,82 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- バックグラウンド処理 ---
+# 読み込み → 照合・集計をジョブとしてスレッドプールで実行する。
+# ジョブは入力のキー（ファイル内容のハッシュ、基準日、エイリアス）ごとに1つだけ作り、
+# 処理中にウィジェットを操作して再実行されても、同じジョブにつなぎ直す。
+# HTML生成はジョブの外で行い、GA IDが変わったときはHTMLだけを作り直す。
+
+def upload_memo(file, name, compute):
+    """
+    アップロードファイルから求めた値（内容のハッシュ・シート一覧・エイリアス表）をファイルごとにセッションに保持する。
+    ジョブの進捗確認で再実行されるたびに、ファイル全体を読み直さないようにする。
+    """
+    memo = st.session_state.setdefault('gp_upload_memo', {})
+    key = (file.file_id, name)
+    if key not in memo:
+        memo[key] = compute(file)
+    return memo[key]
+
+def upload_key(file):
+    """アップロードファイルのキャッシュキー（ファイル名と内容のハッシュ）"""
+    from parse_cache import file_content_hash
+    return None if file is None else upload_memo(file, "key", lambda f: (f.name, file_content_hash(f)))
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager():
+    """プロセス共通のジョブ管理（全セッションで共有する）"""
+    from job_manager import JobManager
+    # 完了したジョブの結果は結果キャッシュに移して手放すので、ジョブ側には状態と記録だけを少し残す
+    return JobManager(max_finished=4)
+
+def run_report_job(target_file, actual_file, workbook_file, stream_actual_csv, target_sheet, actual_sheet,
+                   today, dept_aliases):
+    """
+    レポート生成ジョブ（ワーカースレッドで実行）。
+
+    Returns:
+        summary_df / chart_df / chart_compact（セッション・メトリクス出力用のコンパクト表現）/
+        window_index（期間指定集計・トレンド線用の累積和インデックス）の辞書。
+        達成率データが作れなかった場合、chart_compact と window_index は None
+    """
+    from data_processor import load_data, load_actual_csv_streaming, load_workbook_pair, process_data
+    from compact_chart import CompactChart
+    from parse_cache import cached_load
+    from window_index import MonthlyWindowIndex
+    
+    # 読み込み結果はファイル内容のハッシュでキャッシュ（再実行・再起動後も再解析しない）
+    if workbook_file:
+        # 1つのブックを一度だけ開き、目標・実績シートを読み込む
+        target_df, actual_df = cached_load(workbook_file, load_workbook_pair, target_sheet, actual_sheet)
+    else:
+        target_df = cached_load(target_file, load_data)
+        if stream_actual_csv and actual_file.name.lower().endswith('.csv'):
+            actual_df = cached_load(actual_file, load_actual_csv_streaming)
+        else:
+            actual_df = cached_load(actual_file, load_data)
+    
+    summary_df, chart_df = process_data(
+        target_df, actual_df, today=datetime.combine(today, datetime.min.time()), dept_aliases=dept_aliases
+    )
+    result = {"summary_df": summary_df, "chart_df": chart_df, "chart_compact": None, "window_index": None}
+    if summary_df.empty or chart_df.empty:
+        return result
+    
+    result["chart_compact"] = CompactChart.from_chart_df(chart_df)
+    result["window_index"] = MonthlyWindowIndex(chart_df)
+    return result
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def html_stage(job_key, google_analytics_id, _summary_df, _chart_df, _window_index):
+    """HTML生成ステージ：GA IDが変わったときはこのステージだけ再実行する"""
+    from html_generator import generate_html
+    
+    # トレンド線の係数はジョブで作った累積和インデックスから一括で求める
+    return generate_html(
+        _summary_df, _chart_df, google_analytics_id=google_analytics_id, trends=_window_index.linear_trend()
+    )
+
 # --- メイン画面 ---
 st.title("📄 粗利達成率 インタラクティブレポート生成ツール")
 st.markdown("粗利の目標と実績ファイルをアップロードすると、インタラクティブなHTMLレポートをダウンロードできます。")
@@ -32,18 +110,63 @@ st.markdown("---")
 # --- サイドバー ---
 st.sidebar.header("📁 データアップロード")
 
-target_file = st.sidebar.file_uploader(
-    "粗利目標ファイル",
-    type=['xlsx', 'xls', 'csv'],
-    help="診療科別の目標値を含むExcel/CSVファイル"
+upload_mode = st.sidebar.radio(
+    "アップロード形式",
+    ["目標・実績を別ファイルで", "1つのExcelブック（複数シート）"],
+    help="目標シートと実績シートを含む1つのExcelブックもアップロードできます"
 )
 
-actual_file = st.sidebar.file_uploader(
-    "粗利実績ファイル",
-    type=['xlsx', 'xls', 'csv'],
-    help="診療科別の月次実績値を含むExcel/CSVファイル"
+target_file = actual_file = workbook_file = None
+target_sheet = actual_sheet = None
+stream_actual_csv = False
+
+if upload_mode == "目標・実績を別ファイルで":
+    target_file = st.sidebar.file_uploader(
+        "粗利目標ファイル",
+        type=['xlsx', 'xls', 'csv'],
+        help="診療科別の目標値を含むExcel/CSVファイル"
+    )
+
+    actual_file = st.sidebar.file_uploader(
+        "粗利実績ファイル",
+        type=['xlsx', 'xls', 'csv'],
+        help="診療科別の月次実績値を含むExcel/CSVファイル"
+    )
+
+    stream_actual_csv = st.sidebar.checkbox(
+        "実績CSVをストリーミング読込（大容量ファイル向け）",
+        value=False,
+        help="実績CSVを分割して読み込み、メモリ使用量を抑えます。CSVファイルのみ対象です。"
+    )
+else:
+    workbook_file = st.sidebar.file_uploader(
+        "粗利目標・実績ブック",
+        type=['xlsx'],
+        help="目標シートと月次実績シートを含むExcelブック"
+    )
+    
+    if workbook_file:
+        from data_processor import list_excel_sheets
+        
+        # シート選択（「自動判定」はシート名と見出し行から推定）
+        sheet_options = ["自動判定"] + upload_memo(workbook_file, "sheets", list_excel_sheets)
+        target_sheet = st.sidebar.selectbox("目標シート", sheet_options)
+        actual_sheet = st.sidebar.selectbox("実績シート", sheet_options)
+        target_sheet = None if target_sheet == "自動判定" else target_sheet
+        actual_sheet = None if actual_sheet == "自動判定" else actual_sheet
+
+alias_file = st.sidebar.file_uploader(
+    "診療科名エイリアス表（任意）",
+    type=['csv', 'xlsx'],
+    help="1列目に別名、2列目に正式名を記載した表。目標と実績で診療科名の表記が異なる場合に使います。"
 )
 
+# 差し替え・削除されたファイルの保持値は捨てる
+current_file_ids = {file.file_id for file in (target_file, actual_file, workbook_file, alias_file) if file}
+st.session_state['gp_upload_memo'] = {
+    key: value for key, value in st.session_state.get('gp_upload_memo', {}).items() if key[0] in current_file_ids
+}
+
 # Google Analytics IDの入力欄をサイドバーに追加
 st.sidebar.markdown("---")
 st.sidebar.header("⚙️ レポート設定")
@@ -53,22 +176,90 @@ google_analytics_id = st.sidebar.text_input(
     help="HTMLにトラッキングコードを埋め込む場合に入力します。例: G-K6XTL1DM13"
 )
 
+show_timing = st.sidebar.checkbox(
+    "処理時間を計測",
+    value=instrumentation.is_enabled(),
+    help="読み込み・照合・集計・HTML生成などの各ステージの所要時間とメモリ使用量を表示します"
+)
+# 計測の有効・無効はこの実行（セッション）にだけ適用する
+instrumentation.configure("on" if show_timing else "off")
+instrumentation.reset()
+
 # --- メイン処理 ---
-if target_file and actual_file:
-    # 1. データの読み込みと処理
-    with st.spinner("データを読み込み、集計しています..."):
-        target_df = load_data(target_file)
-        actual_df = load_data(actual_file)
+if (target_file and actual_file) or workbook_file:
+    import pandas as pd
+    from data_processor import load_dept_aliases
+    from result_cache import get_result_cache
+    # 1. データの読み込みと処理（バックグラウンドのジョブで実行し、進捗を表示する）
+    load_key = (
+        upload_key(target_file), upload_key(actual_file), upload_key(workbook_file),
+        stream_actual_csv, target_sheet, actual_sheet
+    )
+    today = datetime.now().date()
+    dept_aliases = upload_memo(alias_file, "aliases", load_dept_aliases) if alias_file else {}
+    job_key = (load_key, today, tuple(sorted(dept_aliases.items())))
+    
+    # 同じファイル・設定の結果は全セッションで共有する（各セッションは参照だけを持つ）
+    result_cache = get_result_cache()
+    result = result_cache.get(job_key)
+    job_manager = get_job_manager()
+    # このセッションで実行したジョブ（結果がキャッシュにあっても、処理時間の記録を表示するためにつなぎ直す）
+    job = job_manager.get(st.session_state.get('gp_job_id'))
+    if job is not None and job.key != job_key:
+        job = None
+    if result is None:
+        # キャッシュから外れていても（上限超過・期限切れ）、このセッションが受け取った結果があればそれを使う
+        session_key, session_result = st.session_state.get('gp_result', (None, None))
+        if session_key == job_key:
+            result = result_cache.put(job_key, session_result)
+    if result is None:
+        job_id = job_manager.submit(
+            job_key, run_report_job,
+            target_file, actual_file, workbook_file, stream_actual_csv, target_sheet, actual_sheet,
+            today, dept_aliases,
+            instrumentation_mode=instrumentation.current_mode()
+        )
+        st.session_state['gp_job_id'] = job_id
+        job = job_manager.get(job_id)
+        
+        if not job.finished:
+            # 完了するまで少し待って再実行する（その間にウィジェットを操作しても処理はやり直さない）
+            st.progress(job.progress, text=f"⏳ {job.stage_label}中...（ジョブ {job_id}）")
+            time.sleep(JOB_POLL_SECONDS)
+            st.rerun()
+        
+        if job.status == "error":
+            st.error(f"データの処理中にエラーが発生しました: {job.error}")
+            st.stop()
         
-        summary_df, chart_df = process_data(target_df, actual_df, today=datetime.now())
+        result = job.result
+        if result is None:
+            # 他のセッションが結果をキャッシュに移して手放した後（キャッシュにあれば次の実行で使い、なければ作り直す）
+            st.rerun()
+        result = result_cache.put(job_key, result)
+        if result_cache.contains(job_key):
+            # キャッシュに入ったときだけジョブ側の参照を手放す（入らなければ他のセッションがつなぎ直せるよう残す）
+            job_manager.release(job_id)
+    st.session_state['gp_result'] = (job_key, result)
+    
+    summary_df, chart_df = result["summary_df"], result["chart_df"]
 
     # 2. 処理結果の確認
     if not summary_df.empty and not chart_df.empty:
         st.success("✅ データ処理が完了しました。")
         
+        unmatched_departments = chart_df.attrs.get('unmatched_departments', [])
+        if unmatched_departments:
+            st.warning(
+                f"⚠️ 実績データが見つからない診療科が {len(unmatched_departments)}件あります: "
+                + "、".join(unmatched_departments)
+            )
+        
         # セッションステートにデータを保存（CSV出力用）
+        # 共有キャッシュの結果への参照だけを持つ（セッションごとにコピーしない。読み取り専用として扱う）
         st.session_state['gross_profit_summary_df'] = summary_df
         st.session_state['gross_profit_chart_df'] = chart_df
+        st.session_state['gross_profit_chart_compact'] = result["chart_compact"]
         
         # タブで機能を分割
         if CSV_EXPORT_AVAILABLE:
@@ -82,15 +273,28 @@ if target_file and actual_file:
             
             # 画面にサマリーデータを表示して確認
             st.dataframe(summary_df, use_container_width=True)
+            
+            # 任意期間の集計（累積和インデックスから引くため chart_df は再走査しない）
+            with st.expander("📅 期間指定集計"):
+                window_index = result["window_index"]
+                month_options = {m.strftime('%Y/%m'): m for m in window_index.months}
+                month_labels = list(month_options)
+                start_label, end_label = st.select_slider(
+                    "集計期間",
+                    options=month_labels,
+                    value=(month_labels[0], month_labels[-1])
+                )
+                start_month, end_month = month_options[start_label], month_options[end_label]
+                window_df = pd.DataFrame({
+                    "期間実績合計": window_index.window_actual(start_month, end_month),
+                    "期間平均達成率": window_index.window_mean(start_month, end_month),
+                }).rename_axis("診療科").reset_index()
+                st.dataframe(window_df, use_container_width=True)
+            
             st.markdown("---")
 
             # 3. HTMLファイルの生成
-            with st.spinner("インタラクティブHTMLを生成しています..."):
-                final_html = generate_html(
-                    summary_df, 
-                    chart_df, 
-                    google_analytics_id=google_analytics_id
-                )
+            final_html = html_stage(job_key, google_analytics_id, summary_df, chart_df, result["window_index"])
             
             st.success("✅ HTMLレポートの準備ができました。")
             
@@ -124,11 +328,28 @@ if target_file and actual_file:
                 """)
                 
                 # メトリクス出力インターフェースを表示
-                create_gross_profit_metrics_export_interface()
+                try:
+                    from gross_profit_metrics_exporter import create_gross_profit_metrics_export_interface
+                    create_gross_profit_metrics_export_interface()
+                except ImportError as e:
+                    st.error(f"CSV出力機能を読み込めませんでした: {e}")
 
     else:
         st.error("データの処理に失敗しました。ファイルの形式が正しいか、中身が空でないか確認してください。")
 
+    # 処理時間の内訳（ジョブの記録 + この実行で計測したステージ）
+    if show_timing:
+        with st.sidebar.expander("⏱️ 処理時間", expanded=True):
+            timing_records = (job.records if job else []) + instrumentation.records()
+            if job is None:
+                st.caption("処理結果は共有キャッシュから取得しました（読み込み・集計は計測されません）。")
+            elif job.records:
+                st.caption(f"ジョブ {job.job_id} の記録を含みます。")
+            if timing_records:
+                st.dataframe(pd.DataFrame(timing_records), use_container_width=True, hide_index=True)
+            elif job is not None:
+                st.caption("計測が無効な間に処理されたため、記録はありません。")
+
 else:
     st.info("👆 サイドバーから粗利目標ファイルと粗利実績ファイルをアップロードしてください。")
     
@@ -157,6 +378,10 @@ else:
         小児科,18000000,22000000,19000000,...
         ```
         
+        **1つのExcelブックでアップロードする場合**
+        - 目標シートと実績シートを同じブックに含めることもできます
+        - シート名に「目標」「実績」を含めると自動判定されます（サイドバーで指定も可能）
+        
         ### 🎯 出力される機能
         
         **HTMLレポート**
@@ -0,0 +1,209 @@
+# batch_reports.py
+"""
+複数施設・複数年度のレポート一括生成
+マニフェスト（JSON）に並べた目標・実績の組ごとに build_report をプロセスプールで並列に実行し、
+結果の一覧を出力先フォルダの batch_summary.json / batch_summary.csv にまとめる。
+
+    python batch_reports.py manifest.json -o reports/ -j 4 -f csv parquet
+
+マニフェストはジョブの配列。name は出力先のサブフォルダ名になる。
+その他のキーは build_report の引数と同じで、相対パスはマニフェストのあるフォルダから解決する。
+
+    [
+      {"name": "A病院_2024", "target": "A/目標_2024.xlsx", "actual": "A/実績_2024*.csv"},
+      {"name": "B病院_2024", "workbook": "B/粗利_2024.xlsx", "today": "2025-03-31", "period_type": "四半期"}
+    ]
+
+1件のジョブが失敗（例外・ワーカープロセスの異常終了）しても他のジョブは続行する。
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from build_report import CLI_FORMATS, build_report
+from data_processor import PERIOD_MONTHS
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FILENAME = "batch_summary"
+# マニフェストで指定できる build_report の引数（out_dir はジョブ名から決める）
+JOB_OPTIONS = (
+    "target", "actual", "workbook", "target_sheet", "actual_sheet", "aliases", "today", "period_type",
+    "formats", "metrics", "google_analytics_id", "stream_actual_csv", "store_path", "trace_memory",
+)
+PATH_OPTIONS = ("target", "actual", "workbook", "aliases", "store_path")
+
+
+def load_manifest(path: str, defaults: Optional[Dict] = None) -> List[Dict]:
+    """
+    マニフェストを読み込み、ジョブごとの build_report の引数に変換する。
+
+    Args:
+        path: マニフェスト（JSON）のパス
+        defaults: 全ジョブ共通の既定値（ジョブ側の指定が優先）
+
+    Raises:
+        ValueError: マニフェストの形式の誤り（ジョブ名の重複・不明なキーなど）
+    """
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("マニフェストはジョブの配列にしてください")
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs, names = [], set()
+    for position, entry in enumerate(entries, start=1):
+        name = str(entry.get("name") or f"job{position:03d}")
+        if name in names:
+            raise ValueError(f"ジョブ名が重複しています: {name}")
+        names.add(name)
+        unknown = [key for key in entry if key != "name" and key not in JOB_OPTIONS]
+        if unknown:
+            raise ValueError(f"{name}: 不明なキー {', '.join(unknown)}")
+
+        options = {**(defaults or {}), **{key: value for key, value in entry.items() if key != "name"}}
+        for key in PATH_OPTIONS:
+            if options.get(key):
+                options[key] = os.path.join(base_dir, options[key])
+        if isinstance(options.get("today"), str):
+            options["today"] = datetime.strptime(options["today"], "%Y-%m-%d")
+        jobs.append({"name": name, "options": options})
+    return jobs
+
+
+def run_job(name: str, out_dir: str, options: Dict) -> Dict:
+    """
+    1件のジョブを実行する（ワーカープロセスで呼ばれる）。
+    例外はここで捕まえて結果に記録し、呼び出し側には投げない。
+    """
+    started = time.perf_counter()
+    result = {"name": name, "status": "ok", "pid": os.getpid(), "out_dir": out_dir, "error": None}
+    try:
+        report = build_report(out_dir, **options)
+        result["outputs"] = report["outputs"]
+        result["departments"] = report["timing"]["departments"]
+        result["metrics"] = report["timing"]["metrics"]
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    return result
+
+
+def run_batch(jobs: List[Dict], out_dir: str, max_workers: Optional[int] = None) -> Dict:
+    """
+    ジョブをプロセスプールで並列に実行し、結果の一覧を返す（マニフェストの順）。
+    一覧は out_dir の batch_summary.json / batch_summary.csv にも書き出す。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    started = time.perf_counter()
+    results = {}
+
+    options = {job["name"]: job["options"] for job in jobs}
+    broken = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(run_job, name, os.path.join(out_dir, name), job_options): name
+            for name, job_options in options.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = _log_result(future.result())
+            except BrokenProcessPool:
+                # どれかのワーカーが異常終了すると、実行中・未実行のジョブがまとめて失敗する
+                broken.append(name)
+
+    # 巻き添えになったジョブは1件ずつ別のプロセスで実行し直し、異常終了したジョブだけを失敗にする
+    for name in broken:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(run_job, name, os.path.join(out_dir, name), options[name]).result()
+            except Exception as e:
+                result = {"name": name, "status": "error", "out_dir": os.path.join(out_dir, name),
+                          "error": f"{type(e).__name__}: {e}", "seconds": None}
+        results[name] = _log_result(result)
+
+    ordered = [results[job["name"]] for job in jobs]
+    summary = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "workers": max_workers or os.cpu_count(),
+        "jobs": len(ordered),
+        "succeeded": sum(result["status"] == "ok" for result in ordered),
+        "failed": sum(result["status"] != "ok" for result in ordered),
+        "wall_seconds": round(time.perf_counter() - started, 6),
+        "job_seconds": round(sum(result["seconds"] or 0 for result in ordered), 6),
+        "results": ordered,
+    }
+    _write_summary(summary, out_dir)
+    return summary
+
+
+def _log_result(result: Dict) -> Dict:
+    if result["status"] == "ok":
+        logger.info(f"[{result['name']}] 完了 {result['seconds']:.2f}秒")
+    else:
+        logger.error(f"[{result['name']}] 失敗: {result['error']}")
+    return result
+
+
+def _write_summary(summary: Dict, out_dir: str):
+    with open(os.path.join(out_dir, f"{SUMMARY_FILENAME}.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+    with open(os.path.join(out_dir, f"{SUMMARY_FILENAME}.csv"), "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ジョブ名", "状態", "所要時間(秒)", "診療科数", "メトリクス数", "出力先", "エラー"])
+        for result in summary["results"]:
+            writer.writerow([
+                result["name"], result["status"], result["seconds"], result.get("departments"),
+                result.get("metrics"), result.get("out_dir"), result["error"] or "",
+            ])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="粗利達成率レポートの一括生成（プロセス並列）")
+    parser.add_argument("manifest", help="ジョブを並べたマニフェスト（JSON）")
+    parser.add_argument("-o", "--out", default="reports", help="出力先フォルダ（ジョブごとにサブフォルダを作る）")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="並列プロセス数（既定: CPUコア数）")
+    parser.add_argument("--today", help="全ジョブ共通の分析基準日 YYYY-MM-DD（ジョブ側の指定が優先）")
+    parser.add_argument("--period", choices=list(PERIOD_MONTHS), help="全ジョブ共通の期間タイプ")
+    parser.add_argument("-f", "--formats", nargs="+", choices=list(CLI_FORMATS), help="全ジョブ共通の出力形式")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+
+    defaults = {}
+    if args.today:
+        defaults["today"] = args.today
+    if args.period:
+        defaults["period_type"] = args.period
+    if args.formats:
+        defaults["formats"] = args.formats
+
+    try:
+        jobs = load_manifest(args.manifest, defaults)
+    except (OSError, ValueError) as e:
+        logger.error(f"マニフェストを読み込めませんでした: {e}")
+        return 1
+
+    summary = run_batch(jobs, args.out, args.jobs)
+    logger.info(
+        f"{summary['jobs']}件中 {summary['succeeded']}件成功・{summary['failed']}件失敗"
+        f"（経過 {summary['wall_seconds']:.2f}秒、ジョブ合計 {summary['job_seconds']:.2f}秒）"
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
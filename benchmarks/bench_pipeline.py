@@ -0,0 +1,265 @@
+# bench_pipeline.py
+"""
+パイプライン全体のベンチマーク
+合成データで load_data → process_data → export_metrics_csv → generate_html を実行し、
+ステージごとの所要時間・スループット・ピークメモリを表示する。
+
+    python benchmarks/bench_pipeline.py                        # 既定のケース
+    python benchmarks/bench_pipeline.py -d 10 500 5000 -m 12 120 -f csv xlsx --dirty 0.2
+    python benchmarks/bench_pipeline.py --save-baseline        # 結果をベースラインとして保存
+    python benchmarks/bench_pipeline.py --compare              # ベースラインと比較（悪化があれば終了コード1）
+    python benchmarks/bench_pipeline.py --importtime           # モジュールの読み込み時間（-X importtime）も表示
+
+所要時間は tracemalloc なしで repeat 回測った最小値、ピークメモリは別に1回測った値。
+読み込み時間は新しいプロセスで repeat 回測った最小値。
+"""
+
+import argparse
+import ast
+import itertools
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import instrumentation
+from data_processor import load_data, process_data
+from gross_profit_metrics_exporter import GrossProfitMetricsExporter
+from html_generator import generate_html
+from synthetic_data import generate_uploads
+
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "results", "baseline.json")
+STAGES = ("load", "match", "rate", "summary", "export", "html")
+ANALYSIS_DATE = datetime(2025, 3, 31)
+# 読み込み時間を測る場面 → 読み込むモジュール（app起動時は app.py の先頭の import から求める）
+IMPORT_SCENARIOS = {
+    "app起動": None,
+    "アップロード後": [
+        "data_processor", "parse_cache", "compact_chart", "window_index", "html_generator", "job_manager", "result_cache",
+    ],
+    "メトリクス出力": ["gross_profit_metrics_exporter", "metrics_backfill"],
+    "CLI": ["build_report"],
+}
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def run_pipeline(departments: int, months: int, file_format: str, dirty_ratio: float, seed: int = 0):
+    """パイプラインを1回実行し、ステージ別の記録（同名ステージは合算）を返す"""
+    target_file, actual_file = generate_uploads(departments, months, file_format, dirty_ratio, seed)
+    instrumentation.reset()
+
+    target_df = load_data(target_file)
+    actual_df = load_data(actual_file)
+    summary_df, chart_df = process_data(target_df, actual_df, today=ANALYSIS_DATE)
+    if chart_df.empty:
+        raise RuntimeError("達成率データが生成できませんでした")
+    GrossProfitMetricsExporter().export_metrics_csv(summary_df, chart_df, analysis_date=ANALYSIS_DATE)
+    generate_html(summary_df, chart_df)
+
+    totals = {}
+    for record in instrumentation.records():
+        total = totals.setdefault(record["stage"], {"seconds": 0.0, "peak_mb": None})
+        total["seconds"] += record["seconds"]
+        if record["peak_mb"] is not None:
+            total["peak_mb"] = max(total["peak_mb"] or 0.0, record["peak_mb"])
+    return totals
+
+
+def bench_case(departments: int, months: int, file_format: str, dirty_ratio: float, repeat: int) -> dict:
+    """1ケースを計測する（所要時間は最小値、メモリは tracemalloc 有効で1回）"""
+    instrumentation.configure("on", trace_memory=False)
+    runs = [run_pipeline(departments, months, file_format, dirty_ratio) for _ in range(repeat)]
+    instrumentation.configure("on", trace_memory=True)
+    memory = run_pipeline(departments, months, file_format, dirty_ratio)
+
+    cells = departments * months
+    stages = {}
+    for name in STAGES:
+        seconds = min(run[name]["seconds"] for run in runs if name in run)
+        stages[name] = {
+            "seconds": round(seconds, 6),
+            "cells_per_sec": round(cells / seconds) if seconds > 0 else None,
+            "peak_mb": memory.get(name, {}).get("peak_mb"),
+        }
+    return {
+        "departments": departments, "months": months, "format": file_format, "dirty_ratio": dirty_ratio,
+        "cells": cells, "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 6),
+        "stages": stages,
+    }
+
+
+def app_startup_modules() -> list:
+    """app.py がモジュールの先頭（関数・分岐の外）で読み込むモジュール"""
+    with open(os.path.join(REPO_ROOT, "app.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def measure_import_time(modules: list, repeat: int) -> dict:
+    """
+    新しいプロセスで modules を読み込み、python -X importtime の出力を集計する。
+    所要時間は指定したモジュールの累積時間の合計（repeat 回の最小値。インタプリタ自体の起動分は除く）、
+    top は指定したモジュールとそれが直接読み込んだモジュールのうち累積時間の大きいものの上位。
+    """
+    roots = {module.split(".")[0] for module in modules}
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        )
+        # 出力は読み込みの完了順で、子モジュールは親より先に字下げ付きで並ぶ
+        total, entries, children = 0.0, {}, {}
+        for line in completed.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if not match:
+                continue
+            depth, name, seconds = len(match.group(3)) // 2, match.group(4), int(match.group(2)) / 1e6
+            if depth == 1:
+                children[name] = seconds
+            elif depth == 0:
+                if name.split(".")[0] in roots:
+                    total += seconds
+                    entries[name] = seconds
+                    entries.update(children)
+                children = {}
+        if best is None or total < best["seconds"]:
+            heaviest = sorted(entries.items(), key=lambda item: item[1], reverse=True)[:5]
+            best = {
+                "modules": modules,
+                "seconds": round(total, 6),
+                "top": [{"module": name, "seconds": round(seconds, 6)} for name, seconds in heaviest],
+            }
+    return best
+
+
+def bench_import_time(repeat: int) -> dict:
+    """IMPORT_SCENARIOS の場面ごとの読み込み時間"""
+    return {
+        name: measure_import_time(modules or app_startup_modules(), repeat)
+        for name, modules in IMPORT_SCENARIOS.items()
+    }
+
+
+def print_import_time(import_time: dict):
+    print("\n[import time]（python -X importtime、新しいプロセス）")
+    for name, scenario in import_time.items():
+        heaviest = ", ".join(f"{item['module']} {item['seconds']:.3f}s" for item in scenario["top"])
+        print(f"  {name:12s} {scenario['seconds']:8.3f}s  {heaviest}")
+
+
+def case_key(case: dict) -> str:
+    return f"{case['format']} d={case['departments']} m={case['months']} dirty={case['dirty_ratio']}"
+
+
+def print_case(case: dict):
+    print(f"\n[{case_key(case)}] 合計 {case['total_seconds']:.3f}s")
+    print(f"  {'stage':8s} {'seconds':>10s} {'cells/s':>14s} {'peak MB':>10s}")
+    for name, stage in case["stages"].items():
+        throughput = f"{stage['cells_per_sec']:,}" if stage["cells_per_sec"] else "-"
+        peak = f"{stage['peak_mb']:.2f}" if stage["peak_mb"] is not None else "-"
+        print(f"  {name:8s} {stage['seconds']:10.4f} {throughput:>14s} {peak:>10s}")
+
+
+def compare(cases: list, baseline: dict, threshold: float) -> list:
+    """ベースラインより threshold 倍以上遅くなったステージの一覧"""
+    baseline_cases = {case_key(case): case for case in baseline.get("cases", [])}
+    regressions = []
+    print(f"\n=== ベースライン比較（{baseline.get('created_at', '')}）===")
+    for case in cases:
+        base = baseline_cases.get(case_key(case))
+        if base is None:
+            print(f"[{case_key(case)}] ベースラインなし")
+            continue
+        for name, stage in case["stages"].items():
+            base_seconds = base["stages"].get(name, {}).get("seconds")
+            if not base_seconds:
+                continue
+            ratio = stage["seconds"] / base_seconds
+            mark = " ← 悪化" if ratio >= threshold else ""
+            print(f"[{case_key(case)}] {name:8s} {base_seconds:.4f}s → {stage['seconds']:.4f}s (x{ratio:.2f}){mark}")
+            if ratio >= threshold:
+                regressions.append((case_key(case), name, ratio))
+    return regressions
+
+
+def compare_import_time(import_time: dict, baseline: dict):
+    """ベースラインとの読み込み時間の比較（計測のばらつきが大きいため悪化の判定には使わない）"""
+    base_import_time = baseline.get("import_time")
+    if not base_import_time:
+        return
+    for name, scenario in import_time.items():
+        base = base_import_time.get(name)
+        if base and base["seconds"]:
+            print(f"[import {name}] {base['seconds']:.3f}s → {scenario['seconds']:.3f}s "
+                  f"(x{scenario['seconds'] / base['seconds']:.2f})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="粗利パイプラインのベンチマーク")
+    parser.add_argument("-d", "--departments", type=int, nargs="+", default=[10, 500],
+                        help="診療科数（10〜5000、複数指定可）")
+    parser.add_argument("-m", "--months", type=int, nargs="+", default=[12, 36],
+                        help="月数（12〜120、複数指定可）")
+    parser.add_argument("-f", "--formats", nargs="+", choices=["csv", "xlsx"], default=["csv"],
+                        help="ファイル形式")
+    parser.add_argument("--dirty", type=float, default=0.1, help="実績値を文字列表記にする割合（0〜1）")
+    parser.add_argument("--repeat", type=int, default=3, help="所要時間の計測回数（最小値を採用）")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, metavar="PATH",
+                        help="結果をベースラインとして保存")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, metavar="PATH",
+                        help="ベースラインと比較")
+    parser.add_argument("--threshold", type=float, default=1.25, help="悪化とみなす所要時間の倍率")
+    parser.add_argument("--importtime", action="store_true",
+                        help="アプリ起動時などのモジュール読み込み時間（-X importtime）も計測する")
+    args = parser.parse_args(argv)
+
+    cases = []
+    for departments, months, file_format in itertools.product(args.departments, args.months, args.formats):
+        case = bench_case(departments, months, file_format, args.dirty, args.repeat)
+        print_case(case)
+        cases.append(case)
+
+    result = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "cases": cases,
+    }
+    if args.importtime:
+        result["import_time"] = bench_import_time(args.repeat)
+        print_import_time(result["import_time"])
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nベースラインを保存しました: {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(cases, baseline, args.threshold)
+        if args.importtime:
+            compare_import_time(result["import_time"], baseline)
+        if regressions:
+            print(f"\n{len(regressions)}件のステージが x{args.threshold} 以上遅くなりました")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# synthetic_data.py
+"""
+ベンチマーク用の合成データ生成
+診療科数・月数・ファイル形式・数値の表記ゆれの割合を変えて、
+目標ファイルと実績ファイル（アップロードと同じ形のファイルオブジェクト）を作る
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+
+DEPT_COLUMN = "診療科名"
+TARGET_COLUMN = "目標粗利"
+FORMATS = ("csv", "xlsx")
+
+
+def generate_frames(departments: int, months: int, dirty_ratio: float = 0.0, missing_ratio: float = 0.02,
+                    start: str = "2015-04-01", seed: int = 0):
+    """
+    目標・実績のデータフレームを生成する。
+
+    Args:
+        departments: 診療科数
+        months: 実績の月数（start から連続）
+        dirty_ratio: 実績値を「12,345,678」「△1,000」「1234円」のような文字列にする割合
+        missing_ratio: 実績値を欠損にする割合
+        start: 最初の月
+        seed: 乱数のシード
+
+    Returns:
+        (target_df, actual_df)。実績は横持ち（診療科名 + 月ごとの列）で、
+        目標と同じ診療科を行順を入れ替えて並べる
+    """
+    rng = np.random.default_rng(seed)
+    depts = [f"診療科{i:05d}" for i in range(departments)]
+    month_labels = pd.date_range(start, periods=months, freq="MS").strftime("%Y-%m-%d")
+
+    target_df = pd.DataFrame({
+        DEPT_COLUMN: depts,
+        TARGET_COLUMN: rng.integers(1_000_000, 50_000_000, departments).astype(float),
+    })
+
+    values = rng.integers(500_000, 60_000_000, (departments, months)).astype(float)
+    cells = values.astype(object)
+    dirty = rng.random(values.shape) < dirty_ratio
+    if dirty.any():
+        styles = rng.integers(0, 3, int(dirty.sum()))
+        dirty_values = values[dirty].astype(np.int64)
+        cells[dirty] = [
+            f"{v:,}" if style == 0 else f"△{v:,}" if style == 1 else f"{v}円"
+            for v, style in zip(dirty_values, styles)
+        ]
+    cells[rng.random(values.shape) < missing_ratio] = np.nan
+
+    actual_df = pd.DataFrame(cells, columns=month_labels)
+    actual_df.insert(0, DEPT_COLUMN, depts)
+    actual_df = actual_df.iloc[rng.permutation(departments)].reset_index(drop=True)
+    return target_df, actual_df
+
+
+def to_upload(df: pd.DataFrame, name: str, file_format: str) -> io.BytesIO:
+    """データフレームを Streamlit のアップロードファイルと同じ形（name 属性付きの BytesIO）に書き出す"""
+    if file_format not in FORMATS:
+        raise ValueError(f"不明なファイル形式: {file_format}（{', '.join(FORMATS)} のいずれか）")
+    buffer = io.BytesIO()
+    if file_format == "csv":
+        df.to_csv(buffer, index=False)
+    else:
+        df.to_excel(buffer, index=False)
+    buffer.seek(0)
+    buffer.name = f"{name}.{file_format}"
+    return buffer
+
+
+def generate_uploads(departments: int, months: int, file_format: str = "csv", dirty_ratio: float = 0.0,
+                     seed: int = 0):
+    """目標・実績をファイル形式に書き出したアップロードファイルの組を返す"""
+    target_df, actual_df = generate_frames(departments, months, dirty_ratio=dirty_ratio, seed=seed)
+    return to_upload(target_df, "target", file_format), to_upload(actual_df, "actual", file_format)
@@ -0,0 +1,228 @@
+# build_report.py
+"""
+レポートのヘッドレス生成（定期実行用のコマンドライン）
+目標・実績ファイルから index.html・メトリクスファイル・処理時間レポートを出力先フォルダに書き出す。
+Streamlit は読み込まないため、cron などから画面なしで実行できる。
+
+    python build_report.py -t 目標.xlsx -a 実績.csv -o report/
+    python build_report.py -t "drop/目標_*.xlsx" -a "drop/実績_*.csv" -o report/ -f csv parquet --store
+    python build_report.py -w 粗利ブック.xlsx -o report/ --period 四半期
+
+パスにはワイルドカード（glob）を使える。複数のファイルが一致した場合は、ファイル名順で最後のもの
+（日付入りのファイル名なら最新のもの）を使う。
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import instrumentation
+from data_processor import (
+    PERIOD_MONTHS, load_actual_csv_streaming, load_data, load_dept_aliases, load_workbook_pair, process_data
+)
+from gross_profit_metrics_exporter import METRIC_NAMES, GrossProfitMetricsExporter
+from html_generator import generate_html
+from window_index import MonthlyWindowIndex
+
+logger = logging.getLogger(__name__)
+
+# コマンドラインの形式名 → EXPORT_FORMATS のキー
+CLI_FORMATS = {"csv": "CSV", "parquet": "Parquet", "arrow": "Arrow IPC"}
+TIMING_FILENAME = "timing.json"
+
+
+def resolve_path(pattern: str) -> str:
+    """パス（ワイルドカード可）を1つのファイルに解決する。複数一致した場合はファイル名順で最後のもの"""
+    matches = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+    if not matches:
+        raise FileNotFoundError(f"ファイルが見つかりません: {pattern}")
+    if len(matches) > 1:
+        logger.info(f"{pattern} に {len(matches)}件一致したため {matches[-1]} を使います")
+    return matches[-1]
+
+
+def _load(path: Optional[str], loader, *args):
+    """ファイルを開いて読み込み関数に渡す（ファイル名は拡張子の判定に使われる）"""
+    if path is None:
+        return None
+    with open(path, "rb") as file:
+        return loader(file, *args)
+
+
+def build_report(
+    out_dir: str,
+    target: Optional[str] = None,
+    actual: Optional[str] = None,
+    workbook: Optional[str] = None,
+    target_sheet: Optional[str] = None,
+    actual_sheet: Optional[str] = None,
+    aliases: Optional[str] = None,
+    today: Optional[datetime] = None,
+    period_type: str = "月次",
+    formats: Sequence[str] = ("csv",),
+    metrics: Optional[List[str]] = None,
+    google_analytics_id: Optional[str] = None,
+    stream_actual_csv: bool = False,
+    store_path: Optional[str] = None,
+    trace_memory: bool = False,
+) -> Dict:
+    """
+    レポート一式を生成して out_dir に書き出す。
+
+    Args:
+        out_dir: 出力先フォルダ（なければ作成）
+        target, actual: 目標・実績ファイルのパス（ワイルドカード可）
+        workbook: 目標・実績シートを含むExcelブックのパス（target / actual の代わり）
+        today: 分析基準日（None は現在日時）
+        period_type: メトリクスの期間タイプ（月次 / 四半期 / 年次）
+        formats: メトリクスの出力形式（csv / parquet / arrow）
+        metrics: 出力するメトリクス名（None は全メトリクス）
+        store_path: 指定するとメトリクスをこの SQLite ストアにも保存する
+
+    Returns:
+        出力ファイルのパスと処理時間の記録。処理時間は out_dir/timing.json にも書き出す
+
+    Raises:
+        FileNotFoundError: 入力ファイルが見つからない
+        ValueError: 引数の誤り、または読み込み・集計の結果が空
+    """
+    if workbook is None and (target is None or actual is None):
+        raise ValueError("目標・実績ファイル、またはExcelブックを指定してください")
+    if period_type not in PERIOD_MONTHS:
+        raise ValueError(f"不明な期間タイプ: {period_type}（{', '.join(PERIOD_MONTHS)} のいずれか）")
+    unknown = [name for name in formats if name not in CLI_FORMATS]
+    if unknown:
+        raise ValueError(f"不明な出力形式: {', '.join(unknown)}（{', '.join(CLI_FORMATS)} のいずれか）")
+    today = today or datetime.now()
+
+    instrumentation.configure("on", trace_memory=trace_memory)
+    instrumentation.reset()
+    started = time.perf_counter()
+
+    inputs = {}
+    if workbook is not None:
+        inputs["workbook"] = resolve_path(workbook)
+        target_df, actual_df = _load(inputs["workbook"], load_workbook_pair, target_sheet, actual_sheet)
+    else:
+        inputs["target"], inputs["actual"] = resolve_path(target), resolve_path(actual)
+        target_df = _load(inputs["target"], load_data)
+        stream = stream_actual_csv and inputs["actual"].lower().endswith(".csv")
+        actual_df = _load(inputs["actual"], load_actual_csv_streaming if stream else load_data)
+    if target_df is None or actual_df is None:
+        raise ValueError(f"ファイルを読み込めませんでした: {inputs}")
+    dept_aliases = {}
+    if aliases is not None:
+        inputs["aliases"] = resolve_path(aliases)
+        dept_aliases = _load(inputs["aliases"], load_dept_aliases)
+
+    summary_df, chart_df = process_data(target_df, actual_df, today=today, dept_aliases=dept_aliases)
+    if summary_df.empty or chart_df.empty:
+        raise ValueError("達成率データを作成できませんでした。ファイルの形式を確認してください")
+    unmatched = chart_df.attrs.get("unmatched_departments", [])
+    if unmatched:
+        logger.warning(f"実績データが見つからない診療科が {len(unmatched)}件あります: {'、'.join(unmatched)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = {}
+
+    trends = MonthlyWindowIndex(chart_df).linear_trend()
+    html = generate_html(summary_df, chart_df, google_analytics_id=google_analytics_id, trends=trends)
+    outputs["html"] = os.path.join(out_dir, "index.html")
+    with open(outputs["html"], "w", encoding="utf-8") as f:
+        f.write(html)
+
+    exporter = GrossProfitMetricsExporter()
+    metrics_df, filename = exporter.export_metrics_csv(summary_df, chart_df, today, period_type, metrics=metrics)
+    for name in formats:
+        export_format = CLI_FORMATS[name]
+        path = os.path.join(out_dir, exporter.export_filename(filename, export_format))
+        with open(path, "wb") as f:
+            f.write(exporter.create_downloadable(metrics_df, export_format).getvalue())
+        outputs[name] = path
+
+    if store_path is not None:
+        from metrics_store import MetricsStore
+        saved = MetricsStore(store_path).append(metrics_df, snapshot_date=today)
+        logger.info(f"メトリクスストアに保存しました: {saved}件（{store_path}）")
+        outputs["store"] = store_path
+
+    timing = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "today": today.date().isoformat(),
+        "period_type": period_type,
+        "inputs": inputs,
+        "departments": int(chart_df["診療科"].nunique()),
+        "metrics": len(metrics_df),
+        "total_seconds": round(time.perf_counter() - started, 6),
+        "stages": instrumentation.records(),
+    }
+    outputs["timing"] = os.path.join(out_dir, TIMING_FILENAME)
+    with open(outputs["timing"], "w", encoding="utf-8") as f:
+        json.dump(timing, f, ensure_ascii=False, indent=2)
+
+    return {"outputs": outputs, "timing": timing}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="粗利達成率レポートのヘッドレス生成")
+    parser.add_argument("-t", "--target", help="目標ファイル（xlsx / xls / csv、ワイルドカード可）")
+    parser.add_argument("-a", "--actual", help="実績ファイル（xlsx / xls / csv、ワイルドカード可）")
+    parser.add_argument("-w", "--workbook", help="目標・実績シートを含むExcelブック（-t / -a の代わり）")
+    parser.add_argument("--target-sheet", help="ブックの目標シート名（省略時は自動判定）")
+    parser.add_argument("--actual-sheet", help="ブックの実績シート名（省略時は自動判定）")
+    parser.add_argument("--aliases", help="診療科名エイリアス表（1列目: 別名、2列目: 正式名）")
+    parser.add_argument("-o", "--out", default="report", help="出力先フォルダ（既定: report）")
+    parser.add_argument("--today", type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+                        help="分析基準日 YYYY-MM-DD（既定: 実行日）")
+    parser.add_argument("--period", choices=list(PERIOD_MONTHS), default="月次", help="メトリクスの期間タイプ")
+    parser.add_argument("-f", "--formats", nargs="+", choices=list(CLI_FORMATS), default=["csv"],
+                        help="メトリクスの出力形式（複数指定可）")
+    parser.add_argument("--metrics", nargs="+", choices=METRIC_NAMES, metavar="NAME",
+                        help="出力するメトリクス名（既定: 全メトリクス）")
+    parser.add_argument("--ga-id", help="HTMLに埋め込む Google Analytics ID")
+    parser.add_argument("--stream-actual-csv", action="store_true", help="実績CSVを分割して読み込む（大容量ファイル向け）")
+    parser.add_argument("--store", nargs="?", const="", metavar="PATH",
+                        help="メトリクスを SQLite ストアにも保存（PATH 省略時は GP_METRICS_STORE または既定の場所）")
+    parser.add_argument("--trace-memory", action="store_true", help="処理時間レポートにピークメモリも記録する")
+    parser.add_argument("-v", "--verbose", action="store_true", help="詳細ログを表示")
+    args = parser.parse_args(argv)
+    if args.workbook is None and (args.target is None or args.actual is None):
+        parser.error("-t と -a、または -w を指定してください")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+
+    store_path = args.store
+    if store_path == "":
+        from metrics_store import DEFAULT_STORE_PATH
+        store_path = DEFAULT_STORE_PATH
+
+    try:
+        result = build_report(
+            args.out, target=args.target, actual=args.actual, workbook=args.workbook,
+            target_sheet=args.target_sheet, actual_sheet=args.actual_sheet, aliases=args.aliases,
+            today=args.today, period_type=args.period, formats=args.formats, metrics=args.metrics,
+            google_analytics_id=args.ga_id, stream_actual_csv=args.stream_actual_csv,
+            store_path=store_path, trace_memory=args.trace_memory,
+        )
+    except (FileNotFoundError, ValueError) as e:
+        logger.error(str(e))
+        return 1
+
+    for name, path in result["outputs"].items():
+        logger.info(f"{name}: {path}")
+    logger.info(f"完了: {result['timing']['total_seconds']:.2f}秒")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
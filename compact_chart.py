@@ -0,0 +1,105 @@
+# compact_chart.py
+"""
+chart_df のコンパクト表現
+セッションに保持するチャートデータを、診療科コード・月番号（int16）・float32 の値で持つ
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+class CompactChart:
+    """
+    chart_df（診療科・月・実績・目標・達成率）を省メモリで保持するクラス。
+
+    - 診療科と目標は「系列」（診療科 × 目標値の組）ごとに一度だけ持ち、各行は系列コードで参照する
+    - 月は年 × 12 + 月 - 1 の int16（月初日として復元する）
+    - 実績・達成率は float32
+
+    行の順序は元の chart_df のまま保持する。公開用のデータフレームへの変換は
+    to_chart_df() で、利用する直前にだけ行う。
+    """
+
+    __slots__ = ("series_codes", "series_departments", "series_targets", "month_ordinals", "actuals", "rates",
+                 "_fingerprint")
+
+    def __init__(self, series_codes, series_departments, series_targets, month_ordinals, actuals, rates):
+        self.series_codes = series_codes
+        self.series_departments = series_departments
+        self.series_targets = series_targets
+        self.month_ordinals = month_ordinals
+        self.actuals = actuals
+        self.rates = rates
+        self._fingerprint = None
+
+    @classmethod
+    def from_chart_df(cls, chart_df: pd.DataFrame) -> "CompactChart":
+        """chart_df からコンパクト表現を作る"""
+        if chart_df.empty:
+            return cls(np.empty(0, dtype=np.int16), pd.Categorical([]), np.empty(0), np.empty(0, dtype=np.int16),
+                       np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32))
+
+        series = pd.MultiIndex.from_arrays([chart_df['診療科'], chart_df['目標']])
+        codes, uniques = pd.factorize(series)
+        code_dtype = np.int16 if len(uniques) <= np.iinfo(np.int16).max else np.int32
+        months = pd.DatetimeIndex(chart_df['月'])
+
+        return cls(
+            series_codes=codes.astype(code_dtype),
+            series_departments=pd.Categorical(uniques.get_level_values(0)),
+            series_targets=uniques.get_level_values(1).to_numpy(dtype=float),
+            month_ordinals=(months.year * 12 + months.month - 1).to_numpy(dtype=np.int16),
+            actuals=chart_df['実績'].to_numpy(dtype=np.float32),
+            rates=chart_df['達成率'].to_numpy(dtype=np.float32),
+        )
+
+    def to_chart_df(self) -> pd.DataFrame:
+        """公開用の chart_df に戻す"""
+        if len(self.series_codes) == 0:
+            return pd.DataFrame()
+        ordinals = self.month_ordinals.astype(np.int64)
+        months = pd.to_datetime(pd.DataFrame({
+            'year': ordinals // 12, 'month': ordinals % 12 + 1, 'day': 1
+        }))
+        return pd.DataFrame({
+            "診療科": np.asarray(self.series_departments, dtype=object)[self.series_codes],
+            "月": months,
+            "実績": self.actuals.astype(float),
+            "目標": self.series_targets[self.series_codes],
+            "達成率": self.rates.astype(float),
+        })
+
+    @property
+    def fingerprint(self) -> str:
+        """内容のハッシュ（派生データのキャッシュキー用。初回だけ計算する）"""
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for array in (self.series_codes, self.series_targets, self.month_ordinals, self.actuals, self.rates):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            digest.update("\x1f".join(map(str, self.series_departments)).encode("utf-8"))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def month_count(self) -> int:
+        """データのある月の数"""
+        return len(np.unique(self.month_ordinals))
+
+    @property
+    def empty(self) -> bool:
+        return len(self.series_codes) == 0
+
+    def __len__(self) -> int:
+        return len(self.series_codes)
+
+    @property
+    def nbytes(self) -> int:
+        """保持している配列のおおよそのバイト数"""
+        return int(
+            self.series_codes.nbytes + self.month_ordinals.nbytes + self.actuals.nbytes
+            + self.rates.nbytes + self.series_targets.nbytes
+            + self.series_departments.codes.nbytes
+            + sum(len(str(name).encode('utf-8')) for name in self.series_departments.categories)
+        )
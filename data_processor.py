@@ -4,86 +4,702 @@ import numpy as np
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import os
+import re
+import warnings
+import logging
+from functools import lru_cache
+
+from window_index import MonthlyWindowIndex
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# 縦持ちの実績データ（load_actual_csv_streaming の出力）の列
+ACTUAL_LONG_COLUMNS = ["診療科", "月", "実績"]
+
+# 以下のキーワードを含む列は日付変換しない
+PRESERVE_KEYWORDS = ['診療科', '名称', '目標', '粗利', '金額', 'target', 'goal', 'amount', '値']
+_PRESERVE_PATTERN = '|'.join(re.escape(keyword) for keyword in PRESERVE_KEYWORDS)
+
+# 和暦の元年の前年（令和1年 = 2019年）
+_ERA_BASE_YEARS = {'r': 2018, '令和': 2018, 'h': 1988, '平成': 1988}
+
+# よく使われる月見出しの高速パス（2024年4月 / 2024-04 / 2024/04/01 / R6.4 / 令和6年4月 など）
+_MONTH_HEADER_PATTERN = re.compile(r"""
+    ^\s*(?:
+        (?P<year>\d{4})\s*(?:年|[-/.])\s*(?P<month>\d{1,2})\s*
+        (?:月(?:\s*(?P<day_ja>\d{1,2})\s*日)?|[-/.]\s*(?P<day>\d{1,2})(?:[ T]00:00(?::00)?)?)?
+      | (?P<era>[RrHh]|令和|平成)\s*(?P<era_year>\d{1,2}|元)\s*[年.\-/]\s*(?P<era_month>\d{1,2})\s*月?
+    )\s*$
+""", re.VERBOSE)
+
+@lru_cache(maxsize=4096)
+def _parse_header_value(header):
+    """
+    高速パスに当てはまらない列名を pd.to_datetime で解釈する（結果はキャッシュ）。
+    日付でなければ None を返す。
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parsed_date = pd.to_datetime(header, errors='coerce')
+    except (ValueError, TypeError):
+        return None
+    return parsed_date if pd.notna(parsed_date) else None
+
+def classify_headers(columns):
+    """
+    列名の一覧をまとめて判定し、日付列は Timestamp に、それ以外は元の列名のまま返す。
+    
+    キーワード判定と月見出しの高速パスは列名全体に対して一度に行い、
+    残りの列名だけをキャッシュ付きの pd.to_datetime にかける。
+    """
+    columns = list(columns)
+    if not columns:
+        return []
+    headers = pd.Series([str(col) for col in columns])
+    preserve = headers.str.lower().str.contains(_PRESERVE_PATTERN, regex=True).to_numpy()
+    
+    # 高速パス：正規表現で年・月（・日）を一括抽出
+    parts = headers.str.extract(_MONTH_HEADER_PATTERN)
+    era_base = parts['era'].str.lower().map(_ERA_BASE_YEARS)
+    era_year = pd.to_numeric(parts['era_year'].replace('元', '1'), errors='coerce')
+    fast_dates = pd.to_datetime(pd.DataFrame({
+        'year': pd.to_numeric(parts['year'], errors='coerce').fillna(era_base + era_year),
+        'month': pd.to_numeric(parts['month'], errors='coerce').fillna(pd.to_numeric(parts['era_month'], errors='coerce')),
+        'day': pd.to_numeric(parts['day'], errors='coerce').fillna(pd.to_numeric(parts['day_ja'], errors='coerce')).fillna(1),
+    }), errors='coerce')
+    
+    new_columns = []
+    for col, keep, fast_date in zip(columns, preserve, fast_dates):
+        if keep:
+            new_columns.append(col)
+        elif pd.notna(fast_date):
+            new_columns.append(fast_date)
+        elif isinstance(col, (datetime, pd.Timestamp)):
+            new_columns.append(pd.Timestamp(col))
+        else:
+            # 日付として解釈を試み、日付でない場合は元のまま保持
+            parsed_date = _parse_header_value(col)
+            new_columns.append(parsed_date if parsed_date is not None else col)
+    return new_columns
+
+def _normalize_columns(df):
+    """列名のうち日付列を Timestamp に変換し、列名が欠損している列を除く"""
+    # 列名を処理（日付列のみを変換）
+    df.columns = classify_headers(df.columns)
+    
+    # NaTの列名を持つ列を削除（ただし、意図的にNoneやNaTにした列は除く）
+    valid_columns = [col for col in df.columns if pd.notna(col)]
+    return df[valid_columns]
+
+def _read_excel_sheet(worksheet):
+    """
+    読み取り専用モードのワークシートを1行ずつ読み、1行目を見出しとしたデータフレームにする。
+    空行は読み飛ばし、見出しが空の列は pd.read_excel と同じく「Unnamed: n」とする。
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    records = [row for row in rows if any(value is not None for value in row)]
+    
+    # 見出しも値もない末尾の列を除く
+    width = len(header)
+    while width > 0 and header[width - 1] is None and all(
+        len(row) < width or row[width - 1] is None for row in records
+    ):
+        width -= 1
+    
+    columns, seen = [], {}
+    for i, name in enumerate(header[:width]):
+        name = f"Unnamed: {i}" if name is None else name
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    
+    records = [tuple(row[:width]) + (None,) * (width - len(row)) for row in records]
+    return pd.DataFrame.from_records(records, columns=columns)
+
+def _open_workbook(file):
+    """Excelブックを読み取り専用（行ストリーミング）で開く"""
+    from openpyxl import load_workbook
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return load_workbook(file, read_only=True, data_only=True)
+
+def list_excel_sheets(file):
+    """Excelブックのシート名一覧を返す"""
+    workbook = _open_workbook(file)
+    try:
+        return list(workbook.sheetnames)
+    finally:
+        workbook.close()
+
+# シート名から目標・実績を判定するキーワード
+TARGET_SHEET_KEYWORDS = ['目標', 'target', 'goal', '予算']
+ACTUAL_SHEET_KEYWORDS = ['実績', 'actual', 'result']
+
+def detect_workbook_sheets(workbook):
+    """
+    ブック内の目標シートと実績シートを推定する。
+    
+    シート名のキーワードで判定し、決まらない場合は見出し行を見て
+    日付列が2列以上あるシートを実績、それ以外を目標とする。
+    
+    Returns:
+        (目標シート名, 実績シート名)。見つからない方は None
+    """
+    def find_by_name(keywords, exclude=None):
+        for name in workbook.sheetnames:
+            if name != exclude and any(keyword in str(name).lower() for keyword in keywords):
+                return name
+        return None
+    
+    target_sheet = find_by_name(TARGET_SHEET_KEYWORDS)
+    actual_sheet = find_by_name(ACTUAL_SHEET_KEYWORDS, exclude=target_sheet)
+    if target_sheet and actual_sheet:
+        return target_sheet, actual_sheet
+    
+    # 見出し行（1行目）だけを読んで判定
+    date_counts, has_target_col = {}, {}
+    for name in workbook.sheetnames:
+        header = [value for value in next(workbook[name].iter_rows(max_row=1, values_only=True), ()) if value is not None]
+        labels = classify_headers(header)
+        date_counts[name] = sum(isinstance(label, pd.Timestamp) for label in labels)
+        has_target_col[name] = len(header) >= 2 and any(
+            keyword in str(label).lower() for label in header[1:] for keyword in ['目標', 'target', 'goal']
+        )
+    
+    if actual_sheet is None:
+        candidates = [name for name, count in date_counts.items() if count >= 2 and name != target_sheet]
+        actual_sheet = max(candidates, key=date_counts.get) if candidates else None
+    if target_sheet is None:
+        candidates = [name for name, count in date_counts.items() if count < 2 and name != actual_sheet]
+        # 目標値らしい列を持つシートを優先
+        candidates.sort(key=lambda name: not has_target_col[name])
+        target_sheet = candidates[0] if candidates else None
+    return target_sheet, actual_sheet
+
+def load_workbook_pair(file, target_sheet=None, actual_sheet=None):
+    """
+    1つのExcelブックから目標シートと実績シートを一度に読み込む。
+    シート名を省略した場合は detect_workbook_sheets で推定する。
+    
+    Returns:
+        (target_df, actual_df)。読み込めなかった方は None
+    """
+    if file is None:
+        return None, None
+    try:
+        with stage("load") as timing:
+            workbook = _open_workbook(file)
+            try:
+                if target_sheet is None or actual_sheet is None:
+                    detected_target, detected_actual = detect_workbook_sheets(workbook)
+                    target_sheet = target_sheet or detected_target
+                    actual_sheet = actual_sheet or detected_actual
+                
+                logger.debug(f"読み込んだファイル: {file.name} (目標シート: {target_sheet}, 実績シート: {actual_sheet})")
+                frames = []
+                for sheet_name in (target_sheet, actual_sheet):
+                    if sheet_name is None:
+                        frames.append(None)
+                        continue
+                    df = _normalize_columns(_read_excel_sheet(workbook[sheet_name]))
+                    logger.debug(f"{sheet_name}: データ形状 {df.shape}")
+                    frames.append(df)
+                return timing.output(tuple(frames))
+            finally:
+                workbook.close()
+    except Exception as e:
+        logger.error(f"Error loading data: {e}")
+        return None, None
 
 def load_data(file):
     """
     アップロードされたExcelまたはCSVファイルを読み込み、列名を日付オブジェクトに変換する。
+    .xlsx は読み取り専用モードで先頭シートを1行ずつ読み込む。
     """
     if file is None:
         return None
     try:
         file_extension = os.path.splitext(file.name)[1].lower()
-        if file_extension == '.csv':
-            df = pd.read_csv(file)
-        elif file_extension in ['.xlsx', '.xls']:
-            df = pd.read_excel(file, header=0)
-        else:
+        if file_extension not in ('.csv', '.xlsx', '.xls'):
             return None # サポート外の形式
+        with stage("load") as timing:
+            if file_extension == '.csv':
+                df = pd.read_csv(file)
+            elif file_extension == '.xlsx':
+                workbook = _open_workbook(file)
+                try:
+                    df = _read_excel_sheet(workbook.worksheets[0])
+                finally:
+                    workbook.close()
+            else:
+                df = pd.read_excel(file, header=0)
 
-        print(f"読み込んだファイル: {file.name}")
-        print(f"列名: {list(df.columns)}")
-        print(f"データ形状: {df.shape}")
-        
-        # 列名を処理（日付列のみを変換）
-        new_columns = {}
-        for col in df.columns:
-            col_str = str(col).lower()
+            logger.debug(f"読み込んだファイル: {file.name} データ形状: {df.shape}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"列名: {list(df.columns)}")
             
-            # 以下のキーワードを含む列は日付変換しない
-            preserve_keywords = ['診療科', '名称', '目標', '粗利', '金額', 'target', 'goal', 'amount', '値']
-            should_preserve = any(keyword in col_str for keyword in preserve_keywords)
+            df = _normalize_columns(df)
             
-            if should_preserve:
-                new_columns[col] = col
-            else:
-                # 日付として解釈を試みる
-                try:
-                    # まず日付形式かチェック
-                    parsed_date = pd.to_datetime(col, errors='coerce')
-                    if pd.notna(parsed_date):
-                        new_columns[col] = parsed_date
-                    else:
-                        # 日付でない場合は元のまま保持
-                        new_columns[col] = col
-                except (ValueError, TypeError):
-                    new_columns[col] = col
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"処理後の列名: {list(df.columns)}")
+            
+            return timing.output(df)
+    except Exception as e:
+        logger.error(f"Error loading data: {e}")
+        return None
+
+def is_actual_long(actual_df):
+    """実績データが load_actual_csv_streaming の縦持ち形式かどうか"""
+    return actual_df is not None and list(actual_df.columns) == ACTUAL_LONG_COLUMNS
+
+def load_actual_csv_streaming(file, chunksize=50_000):
+    """
+    大容量の実績CSVをチャンク単位で読み込み、診療科・月・実績の縦持ちデータに変換する。
+    
+    全列を文字列として読み、チャンクごとにカンマ区切りの数値を変換して縦持ちにするため、
+    ファイル全体を object 型の横持ちデータとして保持しない。
+    同じ診療科が複数行ある場合は最初の行を採用する。
+    """
+    if file is None:
+        return None
+    try:
+        with stage("load") as timing:
+            # 見出し行だけ先に読んで、診療科列（最初の列）と日付列を決める
+            header = pd.read_csv(file, nrows=0).columns
+            file.seek(0)
+            labels = classify_headers(header)
+            date_positions = [i for i, label in enumerate(labels) if i > 0 and isinstance(label, pd.Timestamp)]
+            if not date_positions:
+                logger.error("実績データに日付列が見つかりません")
+                return None
+            months = pd.DatetimeIndex([labels[i] for i in date_positions])
+            
+            dept_codes = {}
+            rejected_cells = 0
+            code_chunks, month_chunks, value_chunks = [], [], []
+            reader = pd.read_csv(
+                file,
+                usecols=[0] + date_positions,
+                dtype={header[i]: str for i in [0] + date_positions},
+                chunksize=chunksize,
+            )
+            for chunk in reader:
+                dept = chunk.iloc[:, 0]
+                # 欠損と既出の診療科を除外（チャンクをまたいでも最初の行を採用）
+                keep = dept.notna() & ~dept.duplicated() & ~dept.isin(dept_codes.keys())
+                chunk = chunk[keep]
+                for name in chunk.iloc[:, 0]:
+                    dept_codes[name] = len(dept_codes)
+                
+                values, rejected = coerce_numeric(chunk.iloc[:, 1:].to_numpy().ravel())
+                values = values.to_numpy()
+                rejected_cells += int(rejected.sum())
+                valid = ~np.isnan(values)
+                codes = np.repeat(chunk.iloc[:, 0].map(dept_codes).to_numpy(dtype=np.int32), len(date_positions))
+                month_pos = np.tile(np.arange(len(date_positions), dtype=np.int16), len(chunk))
+                
+                code_chunks.append(codes[valid])
+                month_chunks.append(month_pos[valid])
+                value_chunks.append(values[valid])
+            
+            codes = np.concatenate(code_chunks) if code_chunks else np.empty(0, dtype=np.int32)
+            month_pos = np.concatenate(month_chunks) if month_chunks else np.empty(0, dtype=np.int16)
+            values = np.concatenate(value_chunks) if value_chunks else np.empty(0)
+            
+            actual_long = pd.DataFrame({
+                "診療科": pd.Categorical.from_codes(codes, categories=list(dept_codes)),
+                "月": months[month_pos],
+                "実績": values,
+            }, columns=ACTUAL_LONG_COLUMNS)
+            
+            logger.debug(f"読み込んだファイル（ストリーミング）: {file.name}")
+            logger.debug(f"診療科数: {len(dept_codes)} 日付列数: {len(date_positions)} レコード数: {len(actual_long)}")
+            if rejected_cells:
+                logger.warning(f"数値に変換できない実績値 {rejected_cells}件")
+            
+            return timing.output(actual_long)
+    except Exception as e:
+        logger.error(f"Error loading data: {e}")
+        return None
+
+# 数値の前後や桁区切りとして取り除く文字（NFKC 正規化後）
+_NUMBER_NOISE_PATTERN = r'[,\s円¥\\]'
+# 負数の記号（△・▲ は会計表記のマイナス）
+_NEGATIVE_MARKS = ('△', '▲')
+
+def coerce_numeric(values):
+    """
+    数値らしい値の列をまとめて float に変換する。
+    
+    全角数字・全角カンマ（NFKC で統一）、カンマ区切り、円記号（¥ ￥ 円、バックスラッシュ）、
+    括弧書きの負数 (1,234)、△・▲ の負数を扱う。
+    
+    Returns:
+        (変換後の値 Series[float], 変換できなかったセルのマスク Series[bool])。
+        欠損・空文字は NaN とし、変換できなかったセルには数えない。
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numbers = values.astype(float)
+        return numbers, pd.Series(False, index=values.index)
+    
+    # 数値・素直な数値文字列はそのまま変換し、失敗したセルだけ文字列として整形する
+    numbers = pd.to_numeric(values, errors='coerce').astype(float)
+    retry = numbers.isna() & values.notna()
+    if retry.any():
+        text = values[retry].astype(str).str.normalize('NFKC').str.replace(_NUMBER_NOISE_PATTERN, '', regex=True)
+        text = text.str.replace('−', '-', regex=False)
+        parenthesized = text.str.fullmatch(r'\(.*\)')
+        text = text.mask(parenthesized, text.str[1:-1])
+        marked = text.str.startswith(_NEGATIVE_MARKS)
+        text = text.mask(marked, text.str[1:])
+        retried = pd.to_numeric(text, errors='coerce')
+        numbers[retry] = retried.where(~(parenthesized | marked), -retried)
+        empty = text.str.len() == 0
+        rejected = pd.Series(False, index=values.index)
+        rejected[retry] = (retried.isna() & ~empty).to_numpy(dtype=bool)
+    else:
+        rejected = pd.Series(False, index=values.index)
+    return numbers, rejected
+
+def normalize_dept_names(names):
+    """
+    診療科名を照合用のキーに正規化する（NFKC で全角・半角を統一し、空白を除去）。
+    欠損はそのまま残す。
+    """
+    names = pd.Series(names)
+    keys = names.astype(str).str.normalize('NFKC').str.replace(r'\s+', '', regex=True)
+    return keys.where(names.notna())
+
+def build_dept_keys(names, dept_aliases=None):
+    """
+    診療科名の照合キーを作る。dept_aliases（別名 → 正式名）があれば正規化後に置き換える。
+    """
+    keys = normalize_dept_names(names)
+    if dept_aliases:
+        alias_keys = dict(zip(
+            normalize_dept_names(list(dept_aliases.keys())),
+            normalize_dept_names(list(dept_aliases.values()))
+        ))
+        keys = keys.map(alias_keys).fillna(keys)
+    return keys
+
+def load_dept_aliases(file):
+    """
+    診療科名のエイリアス表（1列目: 別名、2列目: 正式名）を読み込み、辞書で返す。
+    """
+    if file is None:
+        return {}
+    try:
+        df = pd.read_csv(file, dtype=str) if file.name.lower().endswith('.csv') else pd.read_excel(file, dtype=str)
+        df = df.iloc[:, :2].dropna()
+        return dict(zip(df.iloc[:, 0], df.iloc[:, 1]))
+    except Exception as e:
+        logger.error(f"Error loading data: {e}")
+        return {}
+
+CHART_COLUMNS = ["診療科", "月", "実績", "目標", "達成率"]
+
+def _melt_actual(actual_df, dept_col_actual, date_cols, dept_aliases=None):
+    """
+    実績データ（横持ち）を一度だけ縦持ちに変換する。
+    
+    Returns:
+        (診療科の照合キー, 行オフセット, 月位置, 実績値) のタプル。
+        実績値は診療科ごとに月順で連続して並び、行オフセットで各診療科の範囲を引ける。
+    """
+    # 同じ診療科（照合キーが同じもの）が複数行ある場合は先頭行を採用（旧実装の iloc[0] と同じ）
+    keys = build_dept_keys(actual_df[dept_col_actual], dept_aliases)
+    first_rows = (keys.notna() & ~keys.duplicated()).to_numpy()
+    wide = actual_df[first_rows]
+    keys = keys[first_rows]
+    
+    # 月列をまとめて数値化（文字列の実績値も一括で変換）
+    block = wide[date_cols]
+    if all(pd.api.types.is_numeric_dtype(dtype) for dtype in block.dtypes):
+        values = block.to_numpy(dtype=float)
+    else:
+        numbers, rejected = coerce_numeric(block.to_numpy(dtype=object).ravel())
+        values = numbers.to_numpy().reshape(block.shape)
+        if rejected.any():
+            logger.warning(f"数値に変換できない実績値 {int(rejected.sum())}件")
+    
+    valid = ~np.isnan(values)
+    row_counts = valid.sum(axis=1)
+    row_offsets = np.concatenate([[0], np.cumsum(row_counts)])
+    month_pos = np.nonzero(valid)[1]
+    
+    return pd.Index(keys), row_offsets, month_pos, values[valid]
+
+def _index_actual_long(actual_long, date_cols, dept_aliases=None):
+    """
+    縦持ちの実績データ（診療科・月・実績）を _melt_actual と同じ形に並べ替える。
+    診療科は照合キーの初出順、各診療科の中は月順に並ぶ。
+    """
+    dept = actual_long['診療科']
+    if isinstance(dept.dtype, pd.CategoricalDtype):
+        # カテゴリ（元の診療科名）単位で照合キーを作り、同じキーになる名前は最初のものだけ使う
+        category_keys = build_dept_keys(dept.cat.categories, dept_aliases)
+        category_codes, keys = pd.factorize(category_keys)
+        category_codes[category_keys.duplicated().to_numpy()] = -1
+        codes = np.append(category_codes, -1)[dept.cat.codes.to_numpy()]
+    else:
+        codes, keys = pd.factorize(build_dept_keys(dept, dept_aliases))
+    month_pos = pd.DatetimeIndex(date_cols).get_indexer(pd.DatetimeIndex(actual_long['月']))
+    values = coerce_numeric(actual_long['実績'])[0].to_numpy()
+    
+    valid = (codes >= 0) & (month_pos >= 0) & ~np.isnan(values)
+    codes, month_pos, values = codes[valid], month_pos[valid], values[valid]
+    order = np.lexsort((month_pos, codes))
+    
+    row_counts = np.bincount(codes, minlength=len(keys))
+    row_offsets = np.concatenate([[0], np.cumsum(row_counts)])
+    return pd.Index(keys), row_offsets, month_pos[order], values[order]
+
+def _build_chart_df(target_df, actual_df, dept_col_target, target_value_col, dept_col_actual, date_cols, dept_aliases=None):
+    """
+    達成率データを列単位で一括計算する。
+    
+    実績を縦持ちに変換したうえで、正規化した診療科名（build_dept_keys）をキーに目標とハッシュ結合し、
+    実績・目標・達成率を列として求める。行は目標ファイルの行順 → 月順。
+    
+    Returns:
+        (chart_df, 処理した診療科数)。実績が見つからなかった目標の診療科名は
+        chart_df.attrs['unmatched_departments'] に入れる。
+    """
+    with stage("match", (target_df, actual_df)):
+        if is_actual_long(actual_df):
+            actual_keys, row_offsets, month_pos, actual_values = _index_actual_long(actual_df, date_cols, dept_aliases)
+        else:
+            actual_keys, row_offsets, month_pos, actual_values = _melt_actual(
+                actual_df, dept_col_actual, date_cols, dept_aliases
+            )
         
-        df = df.rename(columns=new_columns)
+        targets = target_df[[dept_col_target, target_value_col]]
         
-        # NaTの列名を持つ列を削除（ただし、意図的にNoneやNaTにした列は除く）
-        valid_columns = [col for col in df.columns if pd.notna(col)]
-        df = df[valid_columns]
+        # 目標の診療科 → 実績行のハッシュ結合（正規化・エイリアス適用後のキーで照合）
+        actual_row = actual_keys.get_indexer(build_dept_keys(targets[dept_col_target], dept_aliases))
+        unmatched = [str(name) for name in targets[dept_col_target][actual_row < 0]]
+        if unmatched:
+            logger.warning(f"実績データが見つからない診療科 {len(unmatched)}件: {', '.join(unmatched)}")
+    
+    with stage("rate") as timing:
+        target_values = targets[target_value_col].to_numpy(dtype=float)
+        use = (actual_row >= 0) & (target_values > 0)  # NaN は比較で False になる
+        actual_row = actual_row[use]
+        target_values = target_values[use]
+        dept_names = targets[dept_col_target].to_numpy()[use]
         
-        print(f"処理後の列名: {list(df.columns)}")
+        # 各目標行に対応する実績の範囲 [start, start + count) をまとめて展開
+        starts = row_offsets[actual_row]
+        counts = row_offsets[actual_row + 1] - starts
+        total = int(counts.sum())
+        block_starts = np.concatenate([[0], np.cumsum(counts)[:-1]]) if len(counts) else counts
+        take = np.repeat(starts - block_starts, counts) + np.arange(total)
         
-        return df
-    except Exception as e:
-        print(f"Error loading data: {e}")
-        return None
+        actual_col = actual_values[take]
+        target_col = np.repeat(target_values, counts)
+        months = pd.DatetimeIndex(date_cols).to_numpy()[month_pos[take]]
+        
+        chart_df = timing.output(pd.DataFrame({
+            "診療科": np.repeat(dept_names, counts),
+            "月": months,
+            "実績": actual_col,
+            "目標": target_col,
+            "達成率": (actual_col / target_col) * 100,
+        }, columns=CHART_COLUMNS))
+    
+    if chart_df.empty:
+        chart_df = pd.DataFrame()
+    chart_df.attrs['unmatched_departments'] = unmatched
+    return chart_df, len(actual_row)
+
+SUMMARY_COLUMNS = ["診療科", "直近月達成率", "今年度平均達成率", "過去6ヶ月平均達成率", "評価コメント", "全体比率", "昨年度同期比"]
+
+def _build_summary_df(chart_df, today, period_type="月次"):
+    """
+    診療科 × 月の集計行列から、サマリー指標を全診療科まとめて計算する。
+    
+    chart_df から累積和インデックスを一度だけ作り、
+    各期間（今年度・過去6ヶ月・昨年度同期）は累積和の差で集計する。
+    四半期・年次に集計した chart_df では、「過去6ヶ月」を comparison_window の比較期間
+    （最新期間の直前の期間）として計算する。
+    """
+    # 最新月を特定
+    most_recent_month_date = chart_df['月'].max()
+    logger.debug(f"最新月: {most_recent_month_date.strftime('%Y/%m')}")
+
+    # 最新月の全診療科の粗利合計
+    recent_month_df = chart_df[chart_df['月'] == most_recent_month_date]
+    total_recent_profit = recent_month_df['実績'].sum()
+    logger.debug(f"最新月の全体粗利合計: {total_recent_profit:,.0f}")
+    
+    # 診療科 × 月 の累積和インデックス（各期間の集計は累積和の差で求める）
+    index = MonthlyWindowIndex(chart_df)
+    
+    # a. 直近月の達成率と実績値
+    recent_rate = index.value_at('rate_first', most_recent_month_date)
+    recent_actual = index.value_at('actual_first', most_recent_month_date).fillna(0)
+    recent_target = index.value_at('target_first', most_recent_month_date)
+    
+    # 全体比率
+    if total_recent_profit > 0:
+        profit_share = (recent_actual / total_recent_profit) * 100
+    else:
+        profit_share = pd.Series(0, index=index.departments)
+    
+    # b. 今年度の平均達成率 (4月始まり)
+    fy_start_year = today.year if today.month >= 4 else today.year - 1
+    fy_start_date = pd.Timestamp(year=fy_start_year, month=4, day=1)
+    fy_avg_rate = index.window_mean(start=fy_start_date)
+    
+    # c. 過去6ヵ月の平均達成率（四半期・年次は最新期間の直前の期間）
+    six_month_avg_rate = index.window_mean(*comparison_window(most_recent_month_date, period_type))
+    
+    # 昨年度同期比（今年度の開始月から最新月までを昨年度の同じ期間と比較）
+    last_fy_start_date = pd.Timestamp(year=fy_start_year-1, month=4, day=1)
+    last_fy_end_month = most_recent_month_date - relativedelta(years=1)
+    current_fy_actual = index.window_actual(start=fy_start_date)
+    last_fy_actual = index.window_actual(last_fy_start_date, last_fy_end_month)
+    yoy_comparison = ((current_fy_actual / last_fy_actual) * 100).where(last_fy_actual > 0)
+    
+    # d. 改善コメント
+    diff = recent_rate - six_month_avg_rate
+    comment = np.select(
+        [diff.isna(), diff > 5, diff < -5],
+        ["", "改善傾向 👍", "悪化傾向 👎"],
+        default="横ばい 😐"
+    )
+    
+    # 各診療科の達成率サマリー（デバッグログ有効時のみ組み立てる）
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("=== 直近月の達成率 ===")
+        for dept_name in recent_rate.index[recent_rate.notna()]:
+            logger.debug(f"{dept_name:15s}: 実績={recent_actual[dept_name]:12,.0f} 目標={recent_target[dept_name]:12,.0f} 達成率={recent_rate[dept_name]:6.1f}% 全体比率={profit_share[dept_name]:5.1f}%")
+    
+    summary_df = pd.DataFrame({
+        "診療科": index.departments,
+        "直近月達成率": recent_rate.to_numpy(),
+        "今年度平均達成率": fy_avg_rate.to_numpy(),
+        "過去6ヶ月平均達成率": six_month_avg_rate.to_numpy(),
+        "評価コメント": comment,
+        "全体比率": profit_share.to_numpy(),
+        "昨年度同期比": yoy_comparison.to_numpy(),
+    }, columns=SUMMARY_COLUMNS)
+    
+    return summary_df
+
+# 期間タイプごとの月数（四半期・年次は4月始まりの年度で区切る）
+PERIOD_MONTHS = {"月次": 1, "四半期": 3, "年次": 12}
+FISCAL_YEAR_START_MONTH = 4
+
+def fiscal_period_start(months, period_type):
+    """各月が属する期間（年度の四半期・年度）の開始月を返す"""
+    span = PERIOD_MONTHS[period_type]
+    months = pd.DatetimeIndex(months)
+    # 1970年1月からの月数を年度の開始月基準にずらして期間の長さで切り捨てる
+    ordinal = (months.year - 1970) * 12 + months.month - FISCAL_YEAR_START_MONTH
+    start = ordinal - ordinal % span + FISCAL_YEAR_START_MONTH - 1
+    return pd.DatetimeIndex(np.asarray(start, dtype='datetime64[M]').astype('datetime64[ns]'))
+
+def comparison_window(latest, period_type):
+    """
+    サマリーの「過去6ヶ月」の期間（開始月, 終了月。両端含む）。
+    月次は最新月までの6ヶ月。四半期・年次は最新期間と比べられるよう最新期間を含めず、
+    直前の6ヶ月分（年次は直前の1年度）の期間にする。月には各期間の開始月を使う。
+    """
+    span = PERIOD_MONTHS[period_type]
+    latest = pd.Timestamp(latest)
+    if span == 1:
+        return latest - relativedelta(months=5), latest
+    periods = max(6 // span, 1)
+    return latest - relativedelta(months=span * periods), latest - relativedelta(months=span)
+
+def format_period_label(start, period_type):
+    """期間の開始月を表示用のラベルにする（2024年04月 / 2024年度Q1 / 2024年度）"""
+    start = pd.Timestamp(start)
+    fiscal_year = start.year if start.month >= FISCAL_YEAR_START_MONTH else start.year - 1
+    if period_type == "四半期":
+        quarter = (start.month - FISCAL_YEAR_START_MONTH) % 12 // 3 + 1
+        return f"{fiscal_year}年度Q{quarter}"
+    if period_type == "年次":
+        return f"{fiscal_year}年度"
+    return start.strftime('%Y年%m月')
+
+def aggregate_chart_df(chart_df, period_type):
+    """
+    月次の chart_df を四半期・年度単位に集計する。
+    実績・目標は期間内の合計（目標はデータのある月の分だけ）、達成率は 実績合計 / 目標合計。
+    「月」には期間の開始月が入る。行は診療科の出現順 → 期間順。
+    """
+    if PERIOD_MONTHS[period_type] == 1 or chart_df.empty:
+        return chart_df
+    df = chart_df[['診療科', '実績', '目標']].assign(月=fiscal_period_start(chart_df['月'], period_type))
+    period_df = df.groupby(['診療科', '月'], sort=False).agg(実績=('実績', 'sum'), 目標=('目標', 'sum')).reset_index()
+    period_df['達成率'] = (period_df['実績'] / period_df['目標']) * 100
+    return period_df[CHART_COLUMNS]
+
+def _sort_summary(summary_df):
+    """直近月達成率の降順（欠損は最後）に並べる"""
+    return summary_df.sort_values(by='直近月達成率', ascending=False, na_position='last').reset_index(drop=True)
 
-def process_data(target_df, actual_df, today=datetime.now()):
+def summarize_period(chart_df, period_type, today=None):
+    """
+    月次の chart_df を期間タイプ（月次・四半期・年次）で集計し、集計後のデータからサマリーを作り直す。
+    サマリーの「直近月」は最新の期間、「過去6ヶ月」は最新期間の直前の期間（comparison_window）を指し、
+    評価コメントは最新期間をその期間と比べる。
+    今年度平均達成率と昨年度同期比は期間の区切りによらない指標なので、月次データの値を使う。
+    today を省略した場合は呼び出し時点の日時を使う。
+    
+    Returns:
+        (summary_df, period_chart_df)。period_chart_df.attrs['period_type'] に期間タイプを入れる
+    """
+    if today is None:
+        today = datetime.now()
+    with stage("aggregate", chart_df) as timing:
+        period_chart_df = aggregate_chart_df(chart_df, period_type).copy()
+        if period_chart_df.empty:
+            summary_df = pd.DataFrame()
+        else:
+            summary_df = _build_summary_df(period_chart_df, today, period_type)
+            if PERIOD_MONTHS[period_type] > 1:
+                monthly_summary = _build_summary_df(chart_df, today).set_index('診療科')
+                for column in ('今年度平均達成率', '昨年度同期比'):
+                    summary_df[column] = summary_df['診療科'].map(monthly_summary[column])
+            summary_df = _sort_summary(summary_df)
+        period_chart_df.attrs['period_type'] = period_type
+        return timing.output((summary_df, period_chart_df))
+
+def process_data(target_df, actual_df, today=datetime.now(), dept_aliases=None):
     """
     目標と実績のデータフレームを処理し、サマリーと詳細チャート用のデータフレームを生成する。
+    dept_aliases（別名 → 正式名の辞書）を渡すと、診療科名の照合に使う。
     """
     if target_df is None or actual_df is None:
         return pd.DataFrame(), pd.DataFrame()
 
-    print("\n=== 目標データの確認 ===")
-    print(f"目標データの列: {list(target_df.columns)}")
-    print(f"目標データの形状: {target_df.shape}")
-    print(f"目標データの最初の5行:\n{target_df.head()}")
-    
-    print("\n=== 実績データの確認 ===")
-    print(f"実績データの列名の型: {[type(col).__name__ for col in actual_df.columns]}")
-    print(f"実績データの形状: {actual_df.shape}")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug(f"目標データの列: {list(target_df.columns)}")
+        logger.debug(f"目標データの形状: {target_df.shape}")
+        logger.debug(f"目標データの最初の5行:\n{target_df.head()}")
+        logger.debug(f"実績データの列名の型: {[type(col).__name__ for col in actual_df.columns]}")
+        logger.debug(f"実績データの形状: {actual_df.shape}")
 
     # --- 1. データの準備 ---
     # 診療科列を特定（最初の列）
     dept_col_target = target_df.columns[0]
     dept_col_actual = actual_df.columns[0]
     
-    print(f"\n診療科列（目標）: {dept_col_target}")
-    print(f"診療科列（実績）: {dept_col_actual}")
+    logger.debug(f"診療科列（目標）: {dept_col_target} 診療科列（実績）: {dept_col_actual}")
     
     # 目標データの目標値列を特定
     target_value_col = None
@@ -95,181 +711,70 @@ def process_data(target_df, actual_df, today=datetime.now()):
             col_str = str(col).lower()
             if '目標' in col_str or 'target' in col_str or 'goal' in col_str:
                 target_value_col = col
-                print(f"目標値列を発見: {col}")
+                logger.debug(f"目標値列を発見: {col}")
                 break
         
         # 見つからない場合は2列目を使用
         if target_value_col is None and len(target_df.columns) > 1:
             target_value_col = target_df.columns[1]
-            print(f"2列目を目標値列として使用: {target_value_col}")
+            logger.debug(f"2列目を目標値列として使用: {target_value_col}")
     
     if target_value_col is None:
-        print("Error: 目標値列が見つかりません。目標ファイルには診療科列と目標値列が必要です。")
-        print(f"現在の列: {list(target_df.columns)}")
+        logger.error(f"目標値列が見つかりません。目標ファイルには診療科列と目標値列が必要です。現在の列: {list(target_df.columns)}")
         return pd.DataFrame(), pd.DataFrame()
     
     # 目標値列のデータ型を確認し、必要なら数値に変換
-    print(f"\n目標値列のデータ型: {target_df[target_value_col].dtype}")
+    logger.debug(f"目標値列のデータ型: {target_df[target_value_col].dtype}")
     if not pd.api.types.is_numeric_dtype(target_df[target_value_col]):
-        print("目標値列を数値に変換します...")
-        target_df[target_value_col] = pd.to_numeric(
-            target_df[target_value_col].astype(str).str.replace(',', '').str.replace('，', ''),
-            errors='coerce'
-        )
+        logger.debug("目標値列を数値に変換します")
+        target_df[target_value_col], rejected = coerce_numeric(target_df[target_value_col])
+        if rejected.any():
+            logger.warning(f"数値に変換できない目標値 {int(rejected.sum())}件")
     
-    print(f"目標値のサンプル:\n{target_df[[dept_col_target, target_value_col]].head()}")
+    if debug:
+        logger.debug(f"目標値のサンプル:\n{target_df[[dept_col_target, target_value_col]].head()}")
     
-    # 実績データから日付列を特定
-    date_cols = sorted([col for col in actual_df.columns if isinstance(col, (datetime, pd.Timestamp))], 
-                      key=lambda x: (x.year, x.month))
+    # 実績データから日付列を特定（縦持ちの場合は月の値から）
+    if is_actual_long(actual_df):
+        date_cols = list(pd.DatetimeIndex(actual_df['月'].dropna().unique()).sort_values())
+    else:
+        date_cols = sorted([col for col in actual_df.columns if isinstance(col, (datetime, pd.Timestamp))], 
+                          key=lambda x: (x.year, x.month))
     
     if not date_cols:
-        print("Error: 実績データに日付列が見つかりません")
-        print(f"実績データの列: {list(actual_df.columns)}")
+        logger.error(f"実績データに日付列が見つかりません。実績データの列: {list(actual_df.columns)}")
         return pd.DataFrame(), pd.DataFrame()
     
-    print(f"\n日付列数: {len(date_cols)}")
-    print(f"期間: {date_cols[0].strftime('%Y/%m')} 〜 {date_cols[-1].strftime('%Y/%m')}")
+    logger.debug(f"日付列数: {len(date_cols)} 期間: {date_cols[0].strftime('%Y/%m')} 〜 {date_cols[-1].strftime('%Y/%m')}")
     
     # --- 2. 達成率の計算 ---
-    chart_data = []
-    processed_depts = 0
+    chart_df, processed_depts = _build_chart_df(
+        target_df, actual_df, dept_col_target, target_value_col, dept_col_actual, date_cols, dept_aliases
+    )
+    
+    logger.debug(f"処理した診療科数: {processed_depts}")
     
-    # 各診療科ごとに処理
-    for _, target_row in target_df.iterrows():
-        dept_name = target_row[dept_col_target]
-        target_value = target_row[target_value_col]
-        
-        # 実績データから同じ診療科のデータを取得
-        actual_rows = actual_df[actual_df[dept_col_actual] == dept_name]
-        
-        if actual_rows.empty:
-            print(f"Warning: {dept_name} の実績データが見つかりません")
-            continue
-            
-        if pd.notna(target_value) and target_value > 0:
-            actual_row = actual_rows.iloc[0]
-            processed_depts += 1
-            
-            for month_col in date_cols:
-                actual_value = actual_row.get(month_col)
-                if pd.notna(actual_value):
-                    # 実績値も数値に変換（必要な場合）
-                    if isinstance(actual_value, str):
-                        try:
-                            actual_value = float(actual_value.replace(',', '').replace('，', ''))
-                        except:
-                            continue
-                    
-                    achievement_rate = (actual_value / target_value) * 100
-                    
-                    chart_data.append({
-                        "診療科": dept_name,
-                        "月": month_col,
-                        "実績": actual_value,
-                        "目標": target_value,
-                        "達成率": achievement_rate
-                    })
-    
-    print(f"\n処理した診療科数: {processed_depts}")
-    
-    chart_df = pd.DataFrame(chart_data)
     if chart_df.empty:
-        print("Error: 達成率データが生成できませんでした")
+        logger.error("達成率データが生成できませんでした")
         return pd.DataFrame(), pd.DataFrame()
 
-    print(f"達成率データ生成完了: {len(chart_df)}レコード")
+    logger.debug(f"達成率データ生成完了: {len(chart_df)}レコード")
 
     # --- 3. 各種指標の計算 ---
-    summary_data = []
-    
-    # 最新月を特定
-    most_recent_month_date = chart_df['月'].max()
-    print(f"\n最新月: {most_recent_month_date.strftime('%Y/%m')}")
-
-    # ★★★ 新規追加：最新月の全診療科の粗利合計を計算 ★★★
-    recent_month_df = chart_df[chart_df['月'] == most_recent_month_date]
-    total_recent_profit = recent_month_df['実績'].sum()
-    print(f"最新月の全体粗利合計: {total_recent_profit:,.0f}")
-    
-    # 各診療科の達成率サマリーを表示
-    print("\n=== 直近月の達成率 ===")
-
-    for dept_name, group in chart_df.groupby('診療科'):
-        group = group.sort_values('月')
-        
-        # a. 直近月の達成率と実績値
-        recent_rate_row = group[group['月'] == most_recent_month_date]
-        recent_rate = recent_rate_row['達成率'].iloc[0] if not recent_rate_row.empty else np.nan
-        recent_actual = recent_rate_row['実績'].iloc[0] if not recent_rate_row.empty else 0 # 実績値を取得
-        
-        # ★★★ 新規追加：全体比率を計算 ★★★
-        profit_share = (recent_actual / total_recent_profit) * 100 if total_recent_profit > 0 else 0
-        
-        # デバッグ: 直近月の詳細
-        if not recent_rate_row.empty:
-            recent_target = recent_rate_row['目標'].iloc[0]
-            print(f"{dept_name:15s}: 実績={recent_actual:12,.0f} 目標={recent_target:12,.0f} 達成率={recent_rate:6.1f}% 全体比率={profit_share:5.1f}%")
-
-        # b. 今年度の平均達成率 (4月始まり)
-        fy_start_year = today.year if today.month >= 4 else today.year - 1
-        fy_start_date = pd.Timestamp(year=fy_start_year, month=4, day=1)
-        fy_df = group[group['月'] >= fy_start_date]
-        fy_avg_rate = fy_df['達成率'].mean() if not fy_df.empty else np.nan
-
-        # c. 過去6ヵ月の平均達成率
-        six_months_ago = most_recent_month_date - relativedelta(months=5)
-        six_month_df = group[(group['月'] >= six_months_ago) & (group['月'] <= most_recent_month_date)]
-        six_month_avg_rate = six_month_df['達成率'].mean() if not six_month_df.empty else np.nan
-
-        # ★★★ 新規追加：昨年度同期比の計算 ★★★
-        # 昨年度の同じ期間（今年度の開始月から最新月まで）を特定
-        last_fy_start_date = pd.Timestamp(year=fy_start_year-1, month=4, day=1)
-        last_fy_end_month = most_recent_month_date - relativedelta(years=1)
-        
-        # 今年度の実績合計
-        current_fy_actual = fy_df['実績'].sum() if not fy_df.empty else 0
-        
-        # 昨年度同期間の実績合計
-        last_fy_df = group[(group['月'] >= last_fy_start_date) & (group['月'] <= last_fy_end_month)]
-        last_fy_actual = last_fy_df['実績'].sum() if not last_fy_df.empty else 0
+    with stage("summary", chart_df) as timing:
+        summary_df = _build_summary_df(chart_df, today)
         
-        # 昨年度同期比率の計算
-        yoy_comparison = ((current_fy_actual / last_fy_actual) * 100) if last_fy_actual > 0 else np.nan
-
-        # d. 改善コメント
-        comment = ""
-        if pd.notna(recent_rate) and pd.notna(six_month_avg_rate):
-            diff = recent_rate - six_month_avg_rate
-            if diff > 5:
-                comment = "改善傾向 👍"
-            elif diff < -5:
-                comment = "悪化傾向 👎"
-            else:
-                comment = "横ばい 😐"
-
-        summary_data.append({
-            "診療科": dept_name,
-            "直近月達成率": recent_rate,
-            "今年度平均達成率": fy_avg_rate,
-            "過去6ヶ月平均達成率": six_month_avg_rate,
-            "評価コメント": comment,
-            "全体比率": profit_share,
-            "昨年度同期比": yoy_comparison  # ★★★ 新しい指標を追加 ★★★
-        })
-
-    summary_df = pd.DataFrame(summary_data)
+        # 直近月達成率でソート
+        summary_df = timing.output(_sort_summary(summary_df))
     
-    # 直近月達成率でソート
-    summary_df = summary_df.sort_values(by='直近月達成率', ascending=False, na_position='last').reset_index(drop=True)
-    
-    print(f"\nサマリーデータ生成完了: {len(summary_df)}診療科")
+    logger.debug(f"サマリーデータ生成完了: {len(summary_df)}診療科")
     
     # サマリーの統計情報
-    print("\n=== 統計情報 ===")
-    print(f"目標達成（100%以上）: {len(summary_df[summary_df['直近月達成率'] >= 100])}診療科")
-    print(f"平均達成率: {summary_df['直近月達成率'].mean():.1f}%")
-    print(f"最高達成率: {summary_df['直近月達成率'].max():.1f}%")
-    print(f"最低達成率: {summary_df['直近月達成率'].min():.1f}%")
+    if debug:
+        rates = summary_df['直近月達成率']
+        logger.debug(
+            f"目標達成（100%以上）: {int((rates >= 100).sum())}診療科 "
+            f"平均達成率: {rates.mean():.1f}% 最高達成率: {rates.max():.1f}% 最低達成率: {rates.min():.1f}%"
+        )
 
     return summary_df, chart_df
\ No newline at end of file
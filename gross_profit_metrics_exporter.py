@@ -5,18 +5,241 @@
 """
 
 import pandas as pd
-import streamlit as st
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Callable, NamedTuple
 import logging
 import io
+import os
 import numpy as np
 
 # 既存のデータ処理モジュールからインポート
-from data_processor import process_data
+from data_processor import process_data, summarize_period, format_period_label, comparison_window, PERIOD_MONTHS
+from window_index import MonthlyWindowIndex
+from compact_chart import CompactChart
+from instrumentation import stage
 
 logger = logging.getLogger(__name__)
 
+# 出力列（備考は備考付きのメトリクスがあるときだけ付ける）
+METRIC_COLUMNS = ["診療科名", "メトリクス名", "値", "単位", "期間", "期間タイプ", "カテゴリ", "データ種別", "計算日時", "アプリ名"]
+
+# ダウンロード形式（CSV が既定。Parquet・Arrow IPC は pyarrow で型付きのまま出力する）
+EXPORT_FORMATS = {
+    "CSV": {"extension": ".csv", "mime": "text/csv"},
+    "Parquet": {"extension": ".parquet", "mime": "application/vnd.apache.parquet"},
+    "Arrow IPC": {"extension": ".arrows", "mime": "application/vnd.apache.arrow.stream"},
+}
+
+# 型付き出力で辞書エンコードする文字列列（値の種類が少ない列）
+DICTIONARY_COLUMNS = ["診療科名", "メトリクス名", "単位", "期間", "期間タイプ", "カテゴリ", "データ種別", "アプリ名", "備考"]
+
+# 出力の並び順：セクション順 → 診療科順 → メトリクスの登録順
+METRIC_SECTIONS = ("overall", "department", "trend")
+
+
+class MetricNode(NamedTuple):
+    """中間データのノード。compute は inputs の値を順に受け取る"""
+    name: str
+    inputs: Tuple[str, ...]
+    compute: Callable[..., Any]
+
+
+class MetricSpec(NamedTuple):
+    """
+    メトリクスの定義。
+
+    inputs は計算に使う中間データ（MetricNode）の名前。いずれかが None（データなし）なら出力しない。
+    compute(context) は診療科名（全体指標は「全体」）を添字とする値の Series を返す。
+    NaN の値は出力しない。
+    """
+    name: str
+    section: str
+    unit: str
+    category: str
+    data_kind: str
+    inputs: Tuple[str, ...]
+    compute: Callable[["MetricContext"], pd.Series]
+    digits: Optional[int] = None
+    period: Optional[Callable[["MetricContext"], Tuple[str, str]]] = None  # (期間, 期間タイプ)。None は分析期間
+    note: Optional[Callable[["MetricContext"], pd.Series]] = None  # 備考
+
+
+def _summary_by_department(summary_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    return summary_df.set_index('診療科') if not summary_df.empty else None
+
+
+def _window_index(chart_df: pd.DataFrame) -> Optional[MonthlyWindowIndex]:
+    return MonthlyWindowIndex(chart_df) if not chart_df.empty and '月' in chart_df.columns else None
+
+
+def _rate_distribution(recent_rates: pd.Series) -> Dict[str, int]:
+    """直近月達成率の分布（目標達成・110%以上・100-110%・100%未満の診療科数）"""
+    return {
+        "achieved": int((recent_rates >= 100).sum()),
+        "high": int((recent_rates >= 110).sum()),
+        "good": int(((recent_rates >= 100) & (recent_rates < 110)).sum()),
+        "under": int((recent_rates < 100).sum()),
+    }
+
+
+def _monthly_period(index: MonthlyWindowIndex) -> Tuple[str, str]:
+    """月次データの期間（期間, 期間タイプ）"""
+    return f"{format_period_label(index.months[0], '月次')}〜{format_period_label(index.latest_month, '月次')}", "月次"
+
+
+# 中間データの依存グラフ（summary_df・chart_df・monthly_chart_df・period_info は入力として与える）
+# 時系列メトリクス（index 以下）は期間タイプによらず月次データから計算する
+METRIC_NODES: Dict[str, MetricNode] = {node.name: node for node in (
+    MetricNode("summary", ("summary_df",), _summary_by_department),
+    MetricNode("recent_rates", ("summary",), lambda summary: summary["直近月達成率"]),
+    MetricNode("rate_distribution", ("recent_rates",), _rate_distribution),
+    MetricNode("index", ("monthly_chart_df",), _window_index),
+    MetricNode("monthly_period", ("index",), _monthly_period),
+    MetricNode("trends", ("index",), lambda index: index.linear_trend()),
+    MetricNode("cv_start", ("index",), lambda index: index.latest_month - pd.DateOffset(months=2)),
+    # トレンド分析の対象診療科（最低3ヶ月のデータが必要）
+    MetricNode("trend_departments", ("index",),
+               lambda index: index.departments[index.window_sum('rate_count').to_numpy() >= 3]),
+)}
+
+
+class MetricContext:
+    """
+    メトリクス計算の中間データ。
+    context[name] で参照されたノードだけを、依存するノードから順に計算してキャッシュする。
+    入力のどれかが None のノードは計算せず None になる。
+    """
+
+    def __init__(self, sources: Dict[str, Any], nodes: Dict[str, MetricNode] = METRIC_NODES):
+        self._values = dict(sources)
+        self._nodes = nodes
+        self._resolving = set()
+        self.evaluated: List[str] = []  # 計算したノード（計算順）
+
+    def __getitem__(self, name: str) -> Any:
+        if name in self._values:
+            return self._values[name]
+        if name not in self._nodes:
+            raise KeyError(f"不明な中間データ: {name}")
+        if name in self._resolving:
+            raise ValueError(f"中間データの依存関係が循環しています: {name}")
+        self._resolving.add(name)
+        try:
+            node = self._nodes[name]
+            inputs = [self[dependency] for dependency in node.inputs]
+            value = None if any(value is None for value in inputs) else node.compute(*inputs)
+        finally:
+            self._resolving.discard(name)
+        self._values[name] = value
+        self.evaluated.append(name)
+        return value
+
+
+def _overall(value) -> pd.Series:
+    """全体指標の値"""
+    return pd.Series([value], index=["全体"], dtype=float)
+
+
+def _summary_column(column: str) -> Callable[[MetricContext], pd.Series]:
+    return lambda context: context["summary"][column]
+
+
+def _distribution(key: str) -> Callable[[MetricContext], pd.Series]:
+    return lambda context: _overall(context["rate_distribution"][key])
+
+
+def _evaluation_scores(context: MetricContext) -> pd.Series:
+    """評価コメントを数値スコアに変換（改善 3 / 横ばい 2 / 悪化 1）"""
+    evaluation = context["summary"]["評価コメント"].astype(str)
+    scores = np.select(
+        [evaluation.str.contains("改善傾向", regex=False), evaluation.str.contains("悪化傾向", regex=False)],
+        [3, 1],
+        default=2
+    )
+    return pd.Series(scores, index=evaluation.index, dtype=float)
+
+
+def _recent_cv(context: MetricContext) -> pd.Series:
+    """全診療科の直近3ヶ月の達成率の変動係数"""
+    stats = context["index"].pooled_rate_stats(start=context["cv_start"])
+    if stats["count"] <= 1:
+        return _overall(np.nan)
+    return _overall((stats["std"] / stats["mean"]) * 100)
+
+
+def _trend_slopes(context: MetricContext) -> pd.Series:
+    return context["trends"]["slope"].reindex(context["trend_departments"])
+
+
+def _comparison_period(context: MetricContext) -> Tuple[str, str]:
+    """過去6ヶ月平均達成率の期間。四半期・年次は最新期間の直前の期間（comparison_window）"""
+    period_info = context["period_info"]
+    period_type = period_info["type"]
+    if PERIOD_MONTHS.get(period_type, 1) == 1:
+        return period_info["label"], period_type
+    start, end = (format_period_label(month, period_type)
+                  for month in comparison_window(period_info["latest_month"], period_type))
+    return (start if start == end else f"{start}〜{end}"), period_type
+
+
+def _latest_deviation(context: MetricContext) -> pd.Series:
+    """最新月の達成率と全期間平均との乖離"""
+    index = context["index"]
+    deviation = index.latest_value('rate_first') - index.window_mean()
+    return deviation.reindex(context["trend_departments"])
+
+
+# メトリクスの登録簿（この順に出力する）
+METRIC_REGISTRY: Tuple[MetricSpec, ...] = (
+    # 1. 全体メトリクス
+    MetricSpec("総診療科数", "overall", "科", "全体指標", "実績", ("summary",),
+               lambda c: _overall(len(c["summary"]))),
+    MetricSpec("目標達成診療科数", "overall", "科", "全体指標", "実績", ("rate_distribution",),
+               _distribution("achieved")),
+    MetricSpec("平均達成率", "overall", "%", "全体指標", "実績", ("recent_rates",),
+               lambda c: _overall(c["recent_rates"].mean()), digits=1),
+    MetricSpec("高達成診療科数_110%以上", "overall", "科", "達成率分布", "実績", ("rate_distribution",),
+               _distribution("high")),
+    MetricSpec("標準達成診療科数_100-110%", "overall", "科", "達成率分布", "実績", ("rate_distribution",),
+               _distribution("good")),
+    MetricSpec("未達成診療科数_100%未満", "overall", "科", "達成率分布", "実績", ("rate_distribution",),
+               _distribution("under")),
+    # 2. 診療科別メトリクス
+    MetricSpec("直近月達成率", "department", "%", "診療科別実績", "実績", ("summary",),
+               _summary_column("直近月達成率"), digits=1),
+    MetricSpec("今年度平均達成率", "department", "%", "診療科別実績", "実績", ("summary",),
+               _summary_column("今年度平均達成率"), digits=1),
+    MetricSpec("過去6ヶ月平均達成率", "department", "%", "診療科別実績", "実績", ("summary",),
+               _summary_column("過去6ヶ月平均達成率"), digits=1, period=_comparison_period),
+    MetricSpec("全体比率", "department", "%", "診療科別実績", "実績", ("summary",),
+               _summary_column("全体比率"), digits=1),
+    MetricSpec("昨年度同期比", "department", "%", "診療科別比較", "実績", ("summary",),
+               _summary_column("昨年度同期比"), digits=1),
+    MetricSpec("傾向評価スコア", "department", "ポイント", "診療科別評価", "評価", ("summary",),
+               _evaluation_scores, note=lambda c: c["summary"]["評価コメント"]),
+    # 3. 時系列メトリクス
+    MetricSpec("直近3ヶ月変動係数", "trend", "%", "安定性分析", "実績", ("index", "cv_start"), _recent_cv, digits=2,
+               period=lambda c: (f"{c['cv_start'].strftime('%Y年%m月')}以降", "3ヶ月")),
+    MetricSpec("月次トレンド係数", "trend", "%/月", "診療科別トレンド", "分析", ("trends", "trend_departments"),
+               _trend_slopes, digits=2, period=lambda c: c["monthly_period"]),
+    MetricSpec("最新月平均乖離", "trend", "%", "診療科別トレンド", "分析", ("index", "trend_departments"),
+               _latest_deviation, digits=1, period=lambda c: c["monthly_period"]),
+)
+
+METRIC_NAMES: List[str] = [spec.name for spec in METRIC_REGISTRY]
+
+
+def select_metrics(metrics: Optional[List[str]] = None) -> Tuple[MetricSpec, ...]:
+    """メトリクス名の一覧から登録簿の定義を選ぶ（None は全メトリクス、出力順は登録順）"""
+    if metrics is None:
+        return METRIC_REGISTRY
+    unknown = [name for name in metrics if name not in METRIC_NAMES]
+    if unknown:
+        raise ValueError(f"不明なメトリクス: {', '.join(unknown)}")
+    requested = set(metrics)
+    return tuple(spec for spec in METRIC_REGISTRY if spec.name in requested)
+
+
 class GrossProfitMetricsExporter:
     """粗利分析メトリクス出力クラス"""
     
@@ -29,55 +252,57 @@ class GrossProfitMetricsExporter:
         summary_df: pd.DataFrame,
         chart_df: pd.DataFrame,
         analysis_date: datetime = None,
-        period_type: str = "月次"
+        period_type: str = "月次",
+        metrics: Optional[List[str]] = None,
+        period_frames: Optional[Tuple[pd.DataFrame, pd.DataFrame]] = None
     ) -> Tuple[pd.DataFrame, str]:
         """
         メトリクスデータをCSV形式で出力
         
         Args:
             summary_df: 粗利分析のサマリーデータ
-            chart_df: 粗利分析のチャートデータ
+            chart_df: 粗利分析のチャートデータ（月次）
             analysis_date: 分析基準日
-            period_type: 期間タイプ
+            period_type: 期間タイプ（月次 / 四半期 / 年次）。四半期・年次は4月始まりの年度で
+                実績・目標を集計し直した値から全体・診療科別メトリクスを計算する。
+                時系列メトリクス（変動係数・トレンド係数・乖離）は月次データから計算し、月次として出力する
+            metrics: 出力するメトリクス名（METRIC_NAMES の一部）。None は全メトリクス。
+                要求されたメトリクスに必要な中間データだけを計算する
+            period_frames: 四半期・年次の集計結果（summarize_period の戻り値）。渡せば集計は省く
             
         Returns:
             Tuple[pd.DataFrame, str]: (メトリクスデータフレーム, ファイル名)
         """
         try:
-            if analysis_date is None:
-                analysis_date = datetime.now()
-            
-            # 期間情報設定
-            period_info = self._calculate_period(analysis_date, period_type, chart_df)
-            
-            # メトリクス計算
-            metrics_data = []
-            
-            # 1. 全体メトリクス
-            overall_metrics = self._calculate_overall_metrics(
-                summary_df, chart_df, period_info
-            )
-            metrics_data.extend(overall_metrics)
-            
-            # 2. 診療科別メトリクス
-            dept_metrics = self._calculate_department_metrics(
-                summary_df, period_info
-            )
-            metrics_data.extend(dept_metrics)
-            
-            # 3. 時系列メトリクス
-            trend_metrics = self._calculate_trend_metrics(
-                chart_df, period_info
-            )
-            metrics_data.extend(trend_metrics)
-            
-            # データフレーム作成
-            metrics_df = pd.DataFrame(metrics_data)
-            
-            # ファイル名生成
-            filename = self._generate_filename(analysis_date, period_type)
-            
-            return metrics_df, filename
+            with stage("export", (summary_df, chart_df)) as timing:
+                if analysis_date is None:
+                    analysis_date = datetime.now()
+                
+                if PERIOD_MONTHS.get(chart_df.attrs.get('period_type'), 1) > 1:
+                    raise ValueError("chart_df には月次データを渡してください（集計済みのデータは period_frames に渡す）")
+                monthly_chart_df = chart_df
+                
+                # 四半期・年次は集計した系列から全体・診療科別メトリクスを計算
+                if PERIOD_MONTHS.get(period_type, 1) > 1:
+                    if period_frames is None:
+                        period_frames = summarize_period(chart_df, period_type, analysis_date)
+                    summary_df, chart_df = period_frames
+                
+                # 期間情報設定
+                period_info = self._calculate_period(analysis_date, period_type, chart_df)
+                
+                # メトリクス計算（要求されたメトリクスを列単位で計算して縦に連結）
+                specs = select_metrics(metrics)
+                context = MetricContext({
+                    "summary_df": summary_df, "chart_df": chart_df, "monthly_chart_df": monthly_chart_df,
+                    "period_info": period_info
+                })
+                metrics_df = timing.output(self._build_metrics_df(context, specs))
+                
+                # ファイル名生成
+                filename = self._generate_filename(analysis_date, period_type)
+                
+                return metrics_df, filename
             
         except Exception as e:
             logger.error(f"粗利メトリクス出力エラー: {e}")
@@ -86,16 +311,16 @@ class GrossProfitMetricsExporter:
     def _calculate_period(self, analysis_date: datetime, period_type: str, chart_df: pd.DataFrame) -> Dict:
         """期間情報を計算"""
         if not chart_df.empty and '月' in chart_df.columns:
-            # チャートデータから実際の期間を取得
-            chart_df['月'] = pd.to_datetime(chart_df['月'])
-            min_date = chart_df['月'].min()
-            max_date = chart_df['月'].max()
+            # チャートデータから実際の期間を取得（chart_df は共有されることがあるので変更しない）
+            months = pd.to_datetime(chart_df['月'])
+            min_date = months.min()
+            max_date = months.max()
             
             return {
                 "type": period_type,
                 "start_date": min_date,
                 "end_date": max_date,
-                "label": f"{min_date.strftime('%Y年%m月')}〜{max_date.strftime('%Y年%m月')}",
+                "label": f"{format_period_label(min_date, period_type)}〜{format_period_label(max_date, period_type)}",
                 "latest_month": max_date
             }
         else:
@@ -108,315 +333,63 @@ class GrossProfitMetricsExporter:
                 "latest_month": analysis_date
             }
     
-    def _calculate_overall_metrics(
-        self, 
-        summary_df: pd.DataFrame, 
-        chart_df: pd.DataFrame,
-        period_info: Dict
-    ) -> List[Dict]:
-        """全体メトリクス計算"""
-        metrics = []
-        
-        if summary_df.empty:
-            return metrics
-        
-        # 総診療科数
-        total_depts = len(summary_df)
-        metrics.append({
-            "診療科名": "全体",
-            "メトリクス名": "総診療科数",
-            "値": total_depts,
-            "単位": "科",
-            "期間": period_info["label"],
-            "期間タイプ": period_info["type"],
-            "カテゴリ": "全体指標",
-            "データ種別": "実績",
-            "計算日時": datetime.now().isoformat(),
-            "アプリ名": self.app_name
-        })
-        
-        # 目標達成診療科数（100%以上）
-        achieved_depts = len(summary_df[summary_df['直近月達成率'] >= 100])
-        metrics.append({
-            "診療科名": "全体",
-            "メトリクス名": "目標達成診療科数",
-            "値": achieved_depts,
-            "単位": "科",
-            "期間": period_info["label"],
-            "期間タイプ": period_info["type"],
-            "カテゴリ": "全体指標",
-            "データ種別": "実績",
-            "計算日時": datetime.now().isoformat(),
-            "アプリ名": self.app_name
-        })
-        
-        # 平均達成率
-        avg_achievement = summary_df['直近月達成率'].mean()
-        if not pd.isna(avg_achievement):
-            metrics.append({
-                "診療科名": "全体",
-                "メトリクス名": "平均達成率",
-                "値": round(avg_achievement, 1),
-                "単位": "%",
-                "期間": period_info["label"],
-                "期間タイプ": period_info["type"],
-                "カテゴリ": "全体指標",
-                "データ種別": "実績",
-                "計算日時": datetime.now().isoformat(),
-                "アプリ名": self.app_name
-            })
-        
-        # 達成率分布
-        if not summary_df['直近月達成率'].empty:
-            high_performers = len(summary_df[summary_df['直近月達成率'] >= 110])  # 110%以上
-            good_performers = len(summary_df[(summary_df['直近月達成率'] >= 100) & (summary_df['直近月達成率'] < 110)])  # 100-110%
-            under_performers = len(summary_df[summary_df['直近月達成率'] < 100])  # 100%未満
-            
-            metrics.extend([
-                {
-                    "診療科名": "全体",
-                    "メトリクス名": "高達成診療科数_110%以上",
-                    "値": high_performers,
-                    "単位": "科",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "達成率分布",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                },
-                {
-                    "診療科名": "全体",
-                    "メトリクス名": "標準達成診療科数_100-110%",
-                    "値": good_performers,
-                    "単位": "科",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "達成率分布",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                },
-                {
-                    "診療科名": "全体",
-                    "メトリクス名": "未達成診療科数_100%未満",
-                    "値": under_performers,
-                    "単位": "科",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "達成率分布",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                }
-            ])
-        
-        return metrics
-    
-    def _calculate_department_metrics(
-        self,
-        summary_df: pd.DataFrame,
-        period_info: Dict
-    ) -> List[Dict]:
-        """診療科別メトリクス計算"""
-        metrics = []
-        
-        if summary_df.empty:
-            return metrics
-        
-        for _, row in summary_df.iterrows():
-            dept_name = row['診療科']
-            
-            # 直近月達成率
-            if pd.notna(row['直近月達成率']):
-                metrics.append({
-                    "診療科名": dept_name,
-                    "メトリクス名": "直近月達成率",
-                    "値": round(row['直近月達成率'], 1),
-                    "単位": "%",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "診療科別実績",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                })
-            
-            # 今年度平均達成率
-            if pd.notna(row['今年度平均達成率']):
-                metrics.append({
-                    "診療科名": dept_name,
-                    "メトリクス名": "今年度平均達成率",
-                    "値": round(row['今年度平均達成率'], 1),
-                    "単位": "%",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "診療科別実績",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                })
-            
-            # 過去6ヶ月平均達成率
-            if pd.notna(row['過去6ヶ月平均達成率']):
-                metrics.append({
-                    "診療科名": dept_name,
-                    "メトリクス名": "過去6ヶ月平均達成率",
-                    "値": round(row['過去6ヶ月平均達成率'], 1),
-                    "単位": "%",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "診療科別実績",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                })
-            
-            # 全体比率
-            if pd.notna(row['全体比率']):
-                metrics.append({
-                    "診療科名": dept_name,
-                    "メトリクス名": "全体比率",
-                    "値": round(row['全体比率'], 1),
-                    "単位": "%",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "診療科別実績",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                })
-            
-            # 昨年度同期比
-            if pd.notna(row['昨年度同期比']):
-                metrics.append({
-                    "診療科名": dept_name,
-                    "メトリクス名": "昨年度同期比",
-                    "値": round(row['昨年度同期比'], 1),
-                    "単位": "%",
-                    "期間": period_info["label"],
-                    "期間タイプ": period_info["type"],
-                    "カテゴリ": "診療科別比較",
-                    "データ種別": "実績",
-                    "計算日時": datetime.now().isoformat(),
-                    "アプリ名": self.app_name
-                })
-            
-            # 評価コメント（カテゴリとして）
-            evaluation = row['評価コメント']
-            evaluation_score = self._convert_evaluation_to_score(evaluation)
-            
-            metrics.append({
-                "診療科名": dept_name,
-                "メトリクス名": "傾向評価スコア",
-                "値": evaluation_score,
-                "単位": "ポイント",
-                "期間": period_info["label"],
-                "期間タイプ": period_info["type"],
-                "カテゴリ": "診療科別評価",
-                "データ種別": "評価",
-                "計算日時": datetime.now().isoformat(),
-                "アプリ名": self.app_name,
-                "備考": evaluation
-            })
-        
-        return metrics
-    
-    def _calculate_trend_metrics(
-        self,
-        chart_df: pd.DataFrame,
-        period_info: Dict
-    ) -> List[Dict]:
-        """時系列トレンドメトリクス計算"""
-        metrics = []
-        
-        if chart_df.empty or '月' not in chart_df.columns:
-            return metrics
+    def _build_metrics_df(self, context: MetricContext, specs) -> pd.DataFrame:
+        """
+        メトリクスごとに（診療科の配列 × 値の配列）の列を作り、共通の期間・アプリ情報を付けて連結する。
+        行はセクション順 → 診療科順 → メトリクスの登録順に並べる。
+        """
+        period_info = context["period_info"]
+        calculated_at = datetime.now().isoformat()  # 1回の出力で共通の計算日時
+        blocks = []
         
-        try:
-            # 月列を日付型に変換
-            chart_df['月'] = pd.to_datetime(chart_df['月'])
-            
-            # 最新3ヶ月の変動係数（安定性指標）
-            latest_3_months = chart_df['月'].nlargest(3).min()
-            recent_data = chart_df[chart_df['月'] >= latest_3_months]
-            
-            if not recent_data.empty:
-                # 全体の変動係数
-                achievement_rates = recent_data['達成率']
-                if len(achievement_rates) > 1:
-                    cv = (achievement_rates.std() / achievement_rates.mean()) * 100
-                    
-                    metrics.append({
-                        "診療科名": "全体",
-                        "メトリクス名": "直近3ヶ月変動係数",
-                        "値": round(cv, 2),
-                        "単位": "%",
-                        "期間": f"{latest_3_months.strftime('%Y年%m月')}以降",
-                        "期間タイプ": "3ヶ月",
-                        "カテゴリ": "安定性分析",
-                        "データ種別": "実績",
-                        "計算日時": datetime.now().isoformat(),
-                        "アプリ名": self.app_name
-                    })
-            
-            # 診療科別トレンド分析
-            for dept_name, group in chart_df.groupby('診療科'):
-                group = group.sort_values('月')
+        for section_rank, section in enumerate(METRIC_SECTIONS):
+            section_departments = pd.Index([])
+            for metric_rank, spec in enumerate(specs):
+                if spec.section != section:
+                    continue
+                try:
+                    if any(context[name] is None for name in spec.inputs):
+                        continue  # 必要なデータがない
+                    values = spec.compute(context)
+                except Exception as e:
+                    logger.warning(f"メトリクス計算エラー（{spec.name}）: {e}")
+                    continue
                 
-                if len(group) >= 3:  # 最低3ヶ月のデータが必要
-                    # 線形トレンド計算
-                    x = range(len(group))
-                    y = group['達成率'].values
-                    
-                    # 線形回帰でトレンド係数計算
-                    if len(x) > 1:
-                        slope = np.polyfit(x, y, 1)[0]  # 傾き
-                        
-                        metrics.append({
-                            "診療科名": dept_name,
-                            "メトリクス名": "月次トレンド係数",
-                            "値": round(slope, 2),
-                            "単位": "%/月",
-                            "期間": period_info["label"],
-                            "期間タイプ": period_info["type"],
-                            "カテゴリ": "診療科別トレンド",
-                            "データ種別": "分析",
-                            "計算日時": datetime.now().isoformat(),
-                            "アプリ名": self.app_name
-                        })
-                    
-                    # 最新月 vs 平均との乖離
-                    latest_rate = group.iloc[-1]['達成率']
-                    avg_rate = group['達成率'].mean()
-                    deviation = latest_rate - avg_rate
-                    
-                    metrics.append({
-                        "診療科名": dept_name,
-                        "メトリクス名": "最新月平均乖離",
-                        "値": round(deviation, 1),
-                        "単位": "%",
-                        "期間": period_info["label"],
-                        "期間タイプ": period_info["type"],
-                        "カテゴリ": "診療科別トレンド",
-                        "データ種別": "分析",
-                        "計算日時": datetime.now().isoformat(),
-                        "アプリ名": self.app_name
-                    })
+                # 診療科の並び順はセクション内で最初に現れた順
+                new_departments = values.index[~values.index.isin(section_departments)]
+                section_departments = section_departments.append(new_departments)
+                
+                values = values[values.notna()].astype(float)
+                if spec.digits is not None:
+                    values = values.round(spec.digits)
+                label, label_type = spec.period(context) if spec.period else (period_info["label"], period_info["type"])
+                
+                block = pd.DataFrame({
+                    "診療科名": values.index.to_numpy(dtype=object),
+                    "メトリクス名": spec.name,
+                    "値": values.to_numpy(),
+                    "単位": spec.unit,
+                    "期間": label,
+                    "期間タイプ": label_type,
+                    "カテゴリ": spec.category,
+                    "データ種別": spec.data_kind,
+                    "計算日時": calculated_at,
+                    "アプリ名": self.app_name,
+                    "_section": section_rank,
+                    "_department": section_departments.get_indexer(values.index),
+                    "_metric": metric_rank,
+                }, columns=METRIC_COLUMNS + ["_section", "_department", "_metric"])
+                if spec.note is not None:
+                    block["備考"] = spec.note(context).reindex(values.index).to_numpy(dtype=object)
+                blocks.append(block)
         
-        except Exception as e:
-            logger.warning(f"トレンドメトリクス計算エラー: {e}")
+        if not blocks:
+            return pd.DataFrame()
         
-        return metrics
-    
-    def _convert_evaluation_to_score(self, evaluation: str) -> int:
-        """評価コメントを数値スコアに変換"""
-        if "改善傾向" in str(evaluation):
-            return 3  # ポジティブ
-        elif "悪化傾向" in str(evaluation):
-            return 1  # ネガティブ
-        else:
-            return 2  # ニュートラル
+        metrics_df = pd.concat(blocks, ignore_index=True)
+        order = np.lexsort((metrics_df["_metric"], metrics_df["_department"], metrics_df["_section"]))
+        columns = METRIC_COLUMNS + (["備考"] if "備考" in metrics_df.columns else [])
+        return metrics_df.iloc[order][columns].reset_index(drop=True)
     
     def _generate_filename(self, analysis_date: datetime, period_type: str) -> str:
         """ファイル名生成"""
@@ -429,28 +402,116 @@ class GrossProfitMetricsExporter:
         metrics_df.to_csv(output, index=False, encoding='utf-8-sig')
         output.seek(0)
         return output
+    
+    def to_arrow_table(self, metrics_df: pd.DataFrame):
+        """
+        メトリクスデータを型付きの Arrow テーブルに変換
+        （診療科名・メトリクス名などは辞書エンコード、値は float64、計算日時はタイムスタンプ、スナップショット日は日付）
+        """
+        import pyarrow as pa
+        
+        df = metrics_df.copy()
+        for col in DICTIONARY_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        if '値' in df.columns:
+            df['値'] = pd.to_numeric(df['値'], errors='coerce').astype(float)
+        if '計算日時' in df.columns:
+            df['計算日時'] = pd.to_datetime(df['計算日時'])
+        if 'スナップショット日' in df.columns:
+            df['スナップショット日'] = pd.to_datetime(df['スナップショット日'])
+        
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if '計算日時' in df.columns:
+            position = table.schema.get_field_index('計算日時')
+            table = table.set_column(position, '計算日時', table.column(position).cast(pa.timestamp('us')))
+        if 'スナップショット日' in df.columns:
+            position = table.schema.get_field_index('スナップショット日')
+            table = table.set_column(position, 'スナップショット日', table.column(position).cast(pa.date32()))
+        return table
+    
+    def create_downloadable_parquet(self, metrics_df: pd.DataFrame) -> io.BytesIO:
+        """ダウンロード可能なParquetファイルを作成"""
+        import pyarrow.parquet as pq
+        
+        output = io.BytesIO()
+        pq.write_table(self.to_arrow_table(metrics_df), output)
+        output.seek(0)
+        return output
+    
+    def create_downloadable_arrow(self, metrics_df: pd.DataFrame) -> io.BytesIO:
+        """ダウンロード可能な Arrow IPC ストリームを作成（pyarrow.ipc.open_stream でコピーなしで読める）"""
+        import pyarrow as pa
+        
+        table = self.to_arrow_table(metrics_df)
+        output = io.BytesIO()
+        with pa.ipc.new_stream(output, table.schema) as writer:
+            writer.write_table(table)
+        output.seek(0)
+        return output
+    
+    def create_downloadable(self, metrics_df: pd.DataFrame, export_format: str = "CSV") -> io.BytesIO:
+        """EXPORT_FORMATS のいずれかの形式でダウンロード用データを作成"""
+        if export_format == "Parquet":
+            return self.create_downloadable_parquet(metrics_df)
+        if export_format == "Arrow IPC":
+            return self.create_downloadable_arrow(metrics_df)
+        if export_format == "CSV":
+            return self.create_downloadable_csv(metrics_df)
+        raise ValueError(f"不明な出力形式: {export_format}")
+    
+    @staticmethod
+    def export_filename(filename: str, export_format: str = "CSV") -> str:
+        """ファイル名の拡張子を出力形式に合わせる"""
+        stem, _ = os.path.splitext(filename)
+        return stem + EXPORT_FORMATS[export_format]["extension"]
+
+
+def _period_frames(summary_df: pd.DataFrame, chart_df: pd.DataFrame, fingerprint: str, period_type: str, analysis_date) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    期間タイプ別のサマリーとチャートデータ。
+    チャートデータの内容（fingerprint）・期間タイプ・基準日ごとに一度だけ集計してプロセス共通の結果キャッシュに保持し、
+    期間タイプを切り替えたときや、同じデータを開いている他のセッションでは集計し直さない。
+    返すデータフレームは共有されるため読み取り専用として扱う。
+    """
+    from result_cache import get_result_cache
+    
+    if PERIOD_MONTHS.get(period_type, 1) == 1:
+        # 月次のサマリーは集計時のものをそのまま使う
+        return summary_df, chart_df
+    key = ("period_frames", fingerprint, period_type, analysis_date)
+    return get_result_cache().get_or_compute(
+        key, lambda: summarize_period(chart_df, period_type, datetime.combine(analysis_date, datetime.min.time()))
+    )
 
 
 def create_gross_profit_metrics_export_interface():
     """粗利メトリクス出力インターフェース"""
+    # Streamlit は画面を作るときだけ読み込む（CLI・バッチからの利用では不要）
+    import streamlit as st
+    
     try:
         st.subheader("📊 粗利メトリクス出力")
         
         # セッションからデータ取得
         summary_df = st.session_state.get('gross_profit_summary_df', pd.DataFrame())
-        chart_df = st.session_state.get('gross_profit_chart_df', pd.DataFrame())
+        chart_compact = st.session_state.get('gross_profit_chart_compact', CompactChart.from_chart_df(pd.DataFrame()))
         
-        if summary_df.empty or chart_df.empty:
+        if summary_df.empty or chart_compact.empty:
             st.info("📊 粗利データを処理してからメトリクス出力をご利用ください。")
             st.markdown("メインページで粗利目標ファイルと実績ファイルをアップロードし、データ処理を完了させてください。")
             return
+        # 共有の処理結果のチャートデータがあればそれを使い、なければコンパクト表現から復元する
+        chart_df = st.session_state.get('gross_profit_chart_df')
+        if chart_df is None:
+            chart_df = chart_compact.to_chart_df()
         
         # データ概要表示
         col1, col2, col3 = st.columns(3)
         with col1:
             st.metric("診療科数", len(summary_df))
         with col2:
-            st.metric("分析期間", f"{len(chart_df)}ヶ月分")
+            st.metric("分析期間", f"{chart_compact.month_count}ヶ月分")
         with col3:
             avg_rate = summary_df['直近月達成率'].mean()
             st.metric("平均達成率", f"{avg_rate:.1f}%" if not pd.isna(avg_rate) else "---")
@@ -473,13 +534,27 @@ def create_gross_profit_metrics_export_interface():
                 help="分析の基準となる日付を選択してください"
             )
         
+        selected_metrics = st.multiselect(
+            "出力するメトリクス",
+            METRIC_NAMES,
+            default=METRIC_NAMES,
+            help="選択したメトリクスとその計算に必要なデータだけを計算します"
+        )
+        if not selected_metrics:
+            st.warning("出力するメトリクスを1つ以上選択してください。")
+            return
+        # プレビュー結果を再利用してよいかの判定に使う
+        export_key = (tuple(selected_metrics), analysis_date, period_type)
+        
         # プレビュー表示
         if st.button("📋 メトリクスプレビュー", type="secondary"):
             with st.spinner("メトリクス計算中..."):
                 try:
                     exporter = GrossProfitMetricsExporter()
                     metrics_df, filename = exporter.export_metrics_csv(
-                        summary_df, chart_df, datetime.combine(analysis_date, datetime.min.time()), period_type
+                        summary_df, chart_df, datetime.combine(analysis_date, datetime.min.time()), period_type,
+                        metrics=selected_metrics,
+                        period_frames=_period_frames(summary_df, chart_df, chart_compact.fingerprint, period_type, analysis_date)
                     )
                     
                     st.success(f"✅ メトリクス計算完了: {len(metrics_df)}件のメトリクス")
@@ -510,6 +585,7 @@ def create_gross_profit_metrics_export_interface():
                     # セッションに保存
                     st.session_state['preview_gp_metrics_df'] = metrics_df
                     st.session_state['preview_gp_filename'] = filename
+                    st.session_state['preview_gp_export_key'] = export_key
                     
                 except Exception as e:
                     st.error(f"❌ メトリクス計算エラー: {e}")
@@ -518,37 +594,116 @@ def create_gross_profit_metrics_export_interface():
         # CSV出力
         st.markdown("---")
         
-        if st.button("📥 CSV出力", type="primary"):
+        export_format = st.selectbox(
+            "出力形式",
+            list(EXPORT_FORMATS),
+            help="CSV（既定）のほか、型付きのまま読み込めるParquet・Arrow IPCで出力できます"
+        )
+        save_to_store = st.checkbox(
+            "メトリクスストアにも保存",
+            value=False,
+            help="出力したメトリクスを分析基準日（履歴は各月末）のスナップショットとしてSQLiteストアに蓄積します"
+        )
+        
+        if st.button(f"📥 {export_format}出力", type="primary"):
             try:
-                # プレビューデータがあればそれを使用、なければ新規計算
-                if 'preview_gp_metrics_df' in st.session_state:
+                # 同じ設定のプレビューデータがあればそれを使用、なければ新規計算
+                if 'preview_gp_metrics_df' in st.session_state and st.session_state.get('preview_gp_export_key') == export_key:
                     metrics_df = st.session_state['preview_gp_metrics_df']
                     filename = st.session_state['preview_gp_filename']
                 else:
                     with st.spinner("メトリクス計算中..."):
                         exporter = GrossProfitMetricsExporter()
                         metrics_df, filename = exporter.export_metrics_csv(
-                            summary_df, chart_df, datetime.combine(analysis_date, datetime.min.time()), period_type
+                            summary_df, chart_df, datetime.combine(analysis_date, datetime.min.time()), period_type,
+                            metrics=selected_metrics,
+                            period_frames=_period_frames(
+                                summary_df, chart_df, chart_compact.fingerprint, period_type, analysis_date
+                            )
                         )
                 
-                # CSV出力
+                # 選択した形式で出力
                 exporter = GrossProfitMetricsExporter()
-                csv_data = exporter.create_downloadable_csv(metrics_df)
+                export_data = exporter.create_downloadable(metrics_df, export_format)
+                filename = exporter.export_filename(filename, export_format)
                 
                 st.download_button(
-                    label="💾 粗利メトリクスCSVダウンロード",
-                    data=csv_data,
+                    label=f"💾 粗利メトリクス{export_format}ダウンロード",
+                    data=export_data,
                     file_name=filename,
-                    mime="text/csv",
+                    mime=EXPORT_FORMATS[export_format]["mime"],
                     help=f"{filename} をダウンロードします。ポータル統合用の標準化された粗利メトリクスデータです。"
                 )
                 
-                st.success(f"✅ CSV出力準備完了: {len(metrics_df)}件のメトリクス")
+                st.success(f"✅ {export_format}出力準備完了: {len(metrics_df)}件のメトリクス")
+                if save_to_store:
+                    from metrics_store import get_metrics_store
+                    saved = get_metrics_store().append(metrics_df, snapshot_date=analysis_date)
+                    st.success(f"🗄️ メトリクスストアに保存しました: {saved}件（{analysis_date:%Y/%m/%d}時点）")
                 
             except Exception as e:
-                st.error(f"❌ CSV出力エラー: {e}")
+                st.error(f"❌ {export_format}出力エラー: {e}")
                 logger.error(f"粗利CSV出力エラー: {e}")
         
+        # 履歴バックフィル（各月末時点のメトリクスを一括計算）
+        with st.expander("📚 メトリクス履歴（月末スナップショット）"):
+            from metrics_backfill import backfill_metrics
+            
+            month_labels = [
+                f"{ordinal // 12}/{ordinal % 12 + 1:02d}" for ordinal in np.unique(chart_compact.month_ordinals)
+            ]
+            start_label, end_label = st.select_slider(
+                "スナップショット期間",
+                options=month_labels,
+                value=(month_labels[0], month_labels[-1])
+            ) if len(month_labels) > 1 else (month_labels[0], month_labels[0])
+            
+            if st.button("📚 履歴を計算", type="secondary"):
+                try:
+                    with st.spinner("メトリクス履歴を計算中..."):
+                        backfill_df = backfill_metrics(
+                            chart_df,
+                            start=pd.Timestamp(start_label + "/01"), end=pd.Timestamp(end_label + "/01"),
+                            metrics=selected_metrics, app_name=GrossProfitMetricsExporter().app_name
+                        )
+                    snapshot_count = backfill_df['スナップショット日'].nunique() if not backfill_df.empty else 0
+                    st.success(f"✅ {snapshot_count}時点・{len(backfill_df)}件のメトリクスを計算しました")
+                    st.download_button(
+                        label=f"💾 メトリクス履歴{export_format}ダウンロード",
+                        data=GrossProfitMetricsExporter().create_downloadable(backfill_df, export_format),
+                        file_name=f"{start_label.replace('/', '')}-{end_label.replace('/', '')}_粗利分析_メトリクス履歴"
+                                  + EXPORT_FORMATS[export_format]["extension"],
+                        mime=EXPORT_FORMATS[export_format]["mime"]
+                    )
+                    if save_to_store:
+                        from metrics_store import get_metrics_store
+                        saved = get_metrics_store().append(backfill_df)
+                        st.success(f"🗄️ メトリクスストアに保存しました: {saved}件")
+                except Exception as e:
+                    st.error(f"❌ メトリクス履歴の計算エラー: {e}")
+                    logger.error(f"粗利メトリクス履歴の計算エラー: {e}")
+        
+        # 蓄積済みメトリクスの参照（パイプラインを再実行せずストアから読む）
+        with st.expander("🗄️ メトリクスストア"):
+            from metrics_store import get_metrics_store
+            
+            store = get_metrics_store()
+            try:
+                snapshot_dates = store.snapshot_dates()
+            except Exception as e:
+                snapshot_dates = []
+                st.error(f"❌ メトリクスストアの読み込みエラー: {e}")
+            if not snapshot_dates:
+                st.info("保存済みのメトリクスはありません。「メトリクスストアにも保存」を選んで出力すると蓄積されます。")
+            else:
+                st.caption(f"{len(snapshot_dates)}時点（{snapshot_dates[0]:%Y/%m/%d}〜{snapshot_dates[-1]:%Y/%m/%d}）")
+                store_metric = st.selectbox("メトリクス", METRIC_NAMES, key="gp_store_metric")
+                latest_df = store.latest_per_department(metric=store_metric)
+                st.dataframe(latest_df, use_container_width=True)
+                series_df = store.metric_series(store_metric, department="全体")
+                if len(series_df) > 1:
+                    st.line_chart(series_df.set_index("スナップショット日")["値"])
+        
         # 使用方法説明
         with st.expander("ℹ️ 使用方法とデータ形式"):
             st.markdown("""
@@ -568,7 +723,9 @@ def create_gross_profit_metrics_export_interface():
             - 昨年度同期比
             - 傾向評価スコア
             
-            **トレンド分析**
+            四半期・年次では「直近月」は最新の期間、「過去6ヶ月」はその直前の期間（年次は前年度）を指します。
+            
+            **トレンド分析**（期間タイプによらず月次データから計算）
             - 月次トレンド係数
             - 最新月平均乖離
             - 直近3ヶ月変動係数
@@ -595,5 +752,6 @@ def create_gross_profit_metrics_export_interface():
 
 if __name__ == "__main__":
     # テスト用
+    import streamlit as st
     st.title("粗利メトリクス出力テスト")
     create_gross_profit_metrics_export_interface()
\ No newline at end of file
@@ -4,6 +4,9 @@ import json
 from datetime import datetime
 from typing import Optional
 
+from instrumentation import stage
+from window_index import MonthlyWindowIndex
+
 def format_rate(rate):
     """達成率をフォーマットする補助関数"""
     if pd.isna(rate):
@@ -22,12 +25,28 @@ def get_performance_class(rate):
         return "danger"
 
 # ▼▼▼【修正箇所】引数に google_analytics_id を追加 ▼▼▼
-def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = None):
+def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = None, trends: Optional[pd.DataFrame] = None):
     """
     サマリーとチャートデータからインタラクティブなHTMLレポートを生成する。
     Streamlit-OR-Dashboard風の統一デザインを適用。
     Google Analytics トラッキングコードの埋め込みに対応。
+    trends（MonthlyWindowIndex.linear_trend() の結果）を渡すとトレンド線の再計算を省く。
     """
+    with stage("html", (summary_df, chart_df)):
+        if trends is None:
+            trends = MonthlyWindowIndex(chart_df).linear_trend()
+        return _render_html(summary_df, chart_df, google_analytics_id, trends)
+
+def _trend_json(trends):
+    """トレンド線の係数を診療科ごとの辞書に変換（NaN は null）"""
+    trend_json_data = {}
+    for dept_name, row in trends.iterrows():
+        trend_json_data[dept_name] = {
+            key: (None if pd.isna(row[key]) else float(row[key])) for key in ('slope', 'intercept', 'r2')
+        }
+    return trend_json_data
+
+def _render_html(summary_df, chart_df, google_analytics_id, trends):
     # 1. チャート用データをJavaScriptが扱いやすいJSON形式に変換
     chart_json_data = {}
     for dept_name, group in chart_df.groupby('診療科'):
@@ -35,6 +54,8 @@ def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = Non
         chart_json_data[dept_name] = group.to_dict('records')
     
     chart_json_string = json.dumps(chart_json_data, ensure_ascii=False)
+    # トレンド線はサーバー側で一括計算した係数を使う（ブラウザでは再計算しない）
+    trend_json_string = json.dumps(_trend_json(trends), ensure_ascii=False)
 
     # 2. HTMLのカード部分を生成（新デザインシステム適用）
     cards_html = ""
@@ -289,6 +310,7 @@ def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = Non
     </div>
     <script>
         const chartData = {chart_json_string};
+        const trendData = {trend_json_string};
         const homePageDiv = document.getElementById('homepage');
         const chartPageDiv = document.getElementById('chartpage');
         const chartTitle = document.getElementById('chart-title');
@@ -301,17 +323,11 @@ def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = Non
             if (!data) return;
             const dates = data.map(d => d['月']);
             const rates = data.map(d => d['達成率']);
-            function calculateLinearRegression(x, y) {{
-                const n = x.length; let sumX = 0, sumY = 0, sumXY = 0, sumX2 = 0;
-                for (let i = 0; i < n; i++) {{ const xi = i; sumX += xi; sumY += y[i]; sumXY += xi * y[i]; sumX2 += xi * xi; }}
-                const slope = (n * sumXY - sumX * sumY) / (n * sumX2 - sumX * sumX);
-                const intercept = (sumY - slope * sumX) / n;
-                return {{ slope, intercept }};
-            }}
-            const regression = calculateLinearRegression(dates, rates);
-            const regressionY = dates.map((_, i) => regression.intercept + regression.slope * i);
+            const regression = trendData[deptName] || {{ slope: null, intercept: null, r2: null }};
+            const regressionY = regression.slope === null ? [] : dates.map((_, i) => regression.intercept + regression.slope * i);
+            const trendName = regression.r2 === null ? 'トレンド' : 'トレンド (R²=' + regression.r2.toFixed(2) + ')';
             const trace = {{ x: dates, y: rates, mode: 'lines+markers', type: 'scatter', name: '達成率', line: {{ color: '#3b82f6', width: 3, shape: 'linear' }}, marker: {{ size: 8, color: '#3b82f6', line: {{ color: 'white', width: 2 }} }}, hovertemplate: '<b>%{{x|%Y年%m月}}</b><br>達成率: %{{y:.1f}}%<extra></extra>' }};
-            const regressionTrace = {{ x: dates, y: regressionY, mode: 'lines', type: 'scatter', name: 'トレンド', line: {{ color: '#94a3b8', width: 2, dash: 'dot' }}, hovertemplate: '<b>%{{x|%Y年%m月}}</b><br>トレンド: %{{y:.1f}}%<extra></extra>' }};
+            const regressionTrace = {{ x: dates, y: regressionY, mode: 'lines', type: 'scatter', name: trendName, line: {{ color: '#94a3b8', width: 2, dash: 'dot' }}, hovertemplate: '<b>%{{x|%Y年%m月}}</b><br>トレンド: %{{y:.1f}}%<extra></extra>' }};
             const minRate = Math.min(...rates); const maxRate = Math.max(...rates);
             const yPadding = (maxRate - minRate) * 0.1 || 10;
             const yMin = Math.max(0, minRate - yPadding); const yMax = maxRate + yPadding;
@@ -350,5 +366,6 @@ def generate_html(summary_df, chart_df, google_analytics_id: Optional[str] = Non
         avg_achievement=avg_achievement,
         cards_html=cards_html,
         chart_json_string=chart_json_string,
+        trend_json_string=trend_json_string,
         ga_script_html=ga_script_html
     )
\ No newline at end of file
@@ -0,0 +1,169 @@
+# instrumentation.py
+"""
+処理ステージの計測
+読み込み・照合・達成率計算・サマリー・出力・HTML生成の各ステージについて、
+所要時間・入出力の行数と列数・ピークメモリを記録する
+
+既定では無効。環境変数 GP_INSTRUMENTATION（off / on / json）または configure() で切り替える。
+json を指定すると、各ステージの記録を1行のJSONとしてログに出力する。
+
+ピークメモリ（tracemalloc）はプロセス全体で1つしか測れないため、入れ子の内側のステージや、
+他のスレッドが測定中に始まったステージでは記録しない（peak_mb は None）。
+測定中に他のスレッドが確保したメモリもピークに含まれる点に注意。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("gross_profit.instrumentation")
+
+MODES = ("off", "on", "json")
+
+_default_mode = os.environ.get("GP_INSTRUMENTATION", "off").lower()
+_default_trace_memory = True
+_local = threading.local()
+# tracemalloc を使って測定しているスレッドは同時に1つだけ
+_memory_lock = threading.Lock()
+
+
+def configure(mode: str, this_thread_only: bool = True, trace_memory: Optional[bool] = None):
+    """
+    計測モードを設定する。
+
+    Args:
+        mode: off（無効）/ on（記録のみ）/ json（記録してJSONログにも出力）
+        this_thread_only: True の場合は現在のスレッド（Streamlit ではセッションの実行）だけに適用
+        trace_memory: False にすると tracemalloc を使わない（所要時間だけを正確に測りたいとき）。
+            mode と同じく this_thread_only に従って適用する
+    """
+    global _default_mode, _default_trace_memory
+    if mode not in MODES:
+        raise ValueError(f"不明な計測モード: {mode}（{', '.join(MODES)} のいずれか）")
+    if this_thread_only:
+        _local.mode = mode
+        if trace_memory is not None:
+            _local.trace_memory = trace_memory
+    else:
+        _default_mode = mode
+        if trace_memory is not None:
+            _default_trace_memory = trace_memory
+    if mode == "json" and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def current_mode() -> str:
+    return getattr(_local, "mode", _default_mode)
+
+
+def is_enabled() -> bool:
+    return current_mode() != "off"
+
+
+def _trace_memory() -> bool:
+    return getattr(_local, "trace_memory", _default_trace_memory)
+
+
+def records() -> List[Dict]:
+    """現在のスレッドで記録したステージの一覧"""
+    return list(getattr(_local, "records", []))
+
+
+def reset():
+    """現在のスレッドの記録を消去"""
+    _local.records = []
+
+
+@contextmanager
+def stage_listener(callback):
+    """
+    このブロックの間、現在のスレッドでステージが始まるたびに callback(ステージ名) を呼ぶ。
+    計測の有効・無効に関係なく呼ばれる（バックグラウンド処理の進捗表示用）。
+    """
+    previous = getattr(_local, "listener", None)
+    _local.listener = callback
+    try:
+        yield
+    finally:
+        _local.listener = previous
+
+
+def _shape(data) -> Dict[str, Optional[int]]:
+    """データフレーム（またはそのタプル）の行数・列数"""
+    # 計測が有効なときだけ呼ばれるので、pandas はここで読み込む（アプリの起動を軽くするため）
+    import pandas as pd
+
+    frames = data if isinstance(data, (tuple, list)) else (data,)
+    frames = [df for df in frames if isinstance(df, pd.DataFrame)]
+    if not frames:
+        return {"rows": None, "cols": None}
+    return {"rows": sum(len(df) for df in frames), "cols": sum(df.shape[1] for df in frames)}
+
+
+class _StageRecorder:
+    """stage() の中で出力データを登録するためのオブジェクト"""
+
+    def __init__(self, record: Optional[Dict]):
+        self._record = record
+
+    def output(self, data):
+        """ステージの出力（データフレームまたはそのタプル）を登録"""
+        if self._record is not None:
+            shape = _shape(data)
+            self._record["rows_out"], self._record["cols_out"] = shape["rows"], shape["cols"]
+        return data
+
+
+@contextmanager
+def stage(name: str, inputs=None):
+    """
+    ステージの計測。計測が無効なときは何もしない。
+
+        with stage("summary", chart_df) as s:
+            summary_df = ...
+            s.output(summary_df)
+    """
+    listener = getattr(_local, "listener", None)
+    if listener is not None:
+        listener(name)
+    if not is_enabled():
+        yield _StageRecorder(None)
+        return
+
+    shape = _shape(inputs)
+    record = {"stage": name, "rows_in": shape["rows"], "cols_in": shape["cols"], "rows_out": None, "cols_out": None}
+
+    # ピークメモリは一番外側のステージで、他のスレッドが測定していないときだけ測る
+    depth = getattr(_local, "depth", 0)
+    trace_memory = depth == 0 and _trace_memory() and _memory_lock.acquire(blocking=False)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if trace_memory:
+        tracemalloc.reset_peak()
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield _StageRecorder(record)
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        _local.depth = depth
+        record["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 3) if trace_memory else None
+        if started_tracing:
+            tracemalloc.stop()
+        if trace_memory:
+            _memory_lock.release()
+        if not hasattr(_local, "records"):
+            _local.records = []
+        _local.records.append(record)
+        if current_mode() == "json":
+            logger.info(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,156 @@
+# job_manager.py
+"""
+バックグラウンドジョブの実行
+大きなファイルの処理をスクリプトの実行スレッドから切り離してスレッドプールで動かし、
+ジョブIDで進捗（読み込み・照合・集計）と結果を引けるようにする。
+
+同じキーのジョブは1つだけ作るため、処理中に画面が再実行されても
+処理をやり直さず、実行中または完了済みのジョブにつなぎ直せる。
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# 進捗として表示するステージ（instrumentation のステージ名 → 表示名）。この順に進む
+JOB_STAGES = OrderedDict([
+    ("load", "読み込み"),
+    ("match", "照合"),
+    ("summary", "集計"),
+])
+
+JOB_STATUSES = ("queued", "running", "done", "error")
+
+
+class Job:
+    """
+    1件のジョブの状態。ワーカースレッドが更新し、画面側は読むだけにする。
+    """
+
+    def __init__(self, job_id: str, key: Hashable):
+        self.job_id = job_id
+        self.key = key
+        self.status = "queued"
+        self.stage: Optional[str] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.records: List[Dict] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    @property
+    def progress(self) -> float:
+        """進捗（0〜1）。実行中のステージの手前までを完了とみなす"""
+        if self.status == "done":
+            return 1.0
+        if self.stage not in JOB_STAGES:
+            return 0.0
+        return list(JOB_STAGES).index(self.stage) / len(JOB_STAGES)
+
+    @property
+    def stage_label(self) -> str:
+        """実行中のステージの表示名"""
+        if self.status == "queued":
+            return "待機中"
+        if self.finished:
+            return "完了" if self.status == "done" else "失敗"
+        return JOB_STAGES.get(self.stage, "準備")
+
+    def _on_stage(self, name: str):
+        # 表示するステージだけを進める（戻らない）
+        if name in JOB_STAGES and (self.stage not in JOB_STAGES
+                                   or list(JOB_STAGES).index(name) > list(JOB_STAGES).index(self.stage)):
+            self.stage = name
+
+
+class JobManager:
+    """
+    スレッドプールでジョブを実行し、ジョブIDで状態を引けるようにする。
+
+    submit はキーが同じジョブ（実行中または成功したもの）があればそのIDを返す。
+    完了したジョブは max_finished 件まで保持し、古いものから破棄する。
+    結果を別の場所（結果キャッシュなど）に移したら release で手放し、ジョブ側に残さない。
+    """
+
+    def __init__(self, max_workers: int = 2, max_finished: int = 16):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gp-job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._by_key: Dict[Hashable, str] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, func: Callable, *args, instrumentation_mode: str = "off", **kwargs) -> str:
+        """
+        func(*args, **kwargs) をジョブとして実行し、ジョブIDを返す。
+
+        Args:
+            key: ジョブの同一性を表すキー（入力ファイルのハッシュ・設定など）
+            instrumentation_mode: ワーカースレッドでの計測モード（記録は Job.records に残す）
+        """
+        with self._lock:
+            existing = self._jobs.get(self._by_key.get(key))
+            if existing is not None and existing.status != "error":
+                self._jobs.move_to_end(existing.job_id)
+                return existing.job_id
+
+            job = Job(uuid.uuid4().hex[:12], key)
+            self._jobs[job.job_id] = job
+            self._by_key[key] = job.job_id
+            self._prune()
+        self._executor.submit(self._run, job, func, args, kwargs, instrumentation_mode)
+        logger.debug(f"ジョブ開始: {job.job_id}")
+        return job.job_id
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        """ジョブIDからジョブを返す（破棄済み・不明なIDは None）"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def release(self, job_id: str):
+        """
+        ジョブの結果への参照を手放す（状態と計測の記録は残す）。
+        以降、同じキーの submit は新しいジョブを作る。
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.result = None
+            if self._by_key.get(job.key) == job_id:
+                del self._by_key[job.key]
+
+    def _run(self, job: Job, func: Callable, args, kwargs, instrumentation_mode: str):
+        job.status = "running"
+        instrumentation.configure(instrumentation_mode)
+        instrumentation.reset()
+        try:
+            with instrumentation.stage_listener(job._on_stage):
+                job.result = func(*args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "error"
+            logger.error(f"ジョブ {job.job_id} が失敗しました: {job.error}")
+        finally:
+            job.records = instrumentation.records()
+            job.finished_at = time.time()
+
+    def _prune(self):
+        """完了したジョブを古いものから破棄して max_finished 件に収める（呼び出し側でロック済み）"""
+        finished = [job for job in self._jobs.values() if job.finished]
+        for job in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job.job_id]
+            if self._by_key.get(job.key) == job.job_id:
+                del self._by_key[job.key]
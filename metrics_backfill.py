@@ -0,0 +1,237 @@
+# metrics_backfill.py
+"""
+メトリクス履歴のバックフィル
+各月末時点のメトリクス（その月までのデータで export_metrics_csv を実行した結果に相当）を、
+診療科 × 月の累積和行列を1回走査するだけで全スナップショット分まとめて計算する
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from gross_profit_metrics_exporter import (
+    METRIC_COLUMNS, MetricContext, MetricNode, select_metrics
+)
+from instrumentation import stage
+from window_index import MonthlyWindowIndex
+
+SNAPSHOT_COLUMN = "スナップショット日"
+
+
+def _snapshot_slots(index: MonthlyWindowIndex, start=None, end=None) -> np.ndarray:
+    """スナップショットにする月の位置（データが1件以上ある月のみ）"""
+    n_months = len(index.months)
+    all_slots = np.arange(n_months)
+    has_data = index.window_sum_matrix('rate_count', all_slots, all_slots + 1).sum(axis=0) > 0
+    lo = 0 if start is None else max(int(index.slots([start])[0]), 0)
+    hi = n_months - 1 if end is None else min(int(index.slots([end])[0]), n_months - 1)
+    return all_slots[has_data & (all_slots >= lo) & (all_slots <= hi)]
+
+
+def _window_mean(index: MonthlyWindowIndex, lo, hi) -> np.ndarray:
+    """期間 [lo, hi) の平均達成率（診療科 × スナップショット）"""
+    count = index.window_sum_matrix('rate_count', lo, hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, index.window_sum_matrix('rate_sum', lo, hi) / count, np.nan)
+
+
+def _as_of_values(index: MonthlyWindowIndex, s: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    各スナップショット月 s の時点のサマリー指標（_build_summary_df と同じ定義）。
+    値は診療科 × スナップショットの行列
+    """
+    months = index.months[s]
+    zeros = np.zeros_like(s)
+
+    present = index.window_sum_matrix('rate_count', zeros, s + 1) > 0
+    recent_rate = index.point_matrix('rate_first')[:, s]
+    recent_actual = np.nan_to_num(index.point_matrix('actual_first')[:, s])
+    total_recent = index.window_sum_matrix('actual_sum', s, s + 1).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profit_share = np.where(total_recent > 0, recent_actual / total_recent * 100, 0.0)
+
+    # 今年度（4月始まり）の開始月と昨年度同期
+    fy_years = np.where(months.month >= 4, months.year, months.year - 1)
+    fy_slots = index.slots(pd.to_datetime(pd.DataFrame({'year': fy_years, 'month': 4, 'day': 1})))
+    fy_avg = _window_mean(index, fy_slots, s + 1)
+    six_month_avg = _window_mean(index, s - 5, s + 1)
+    current_fy_actual = index.window_sum_matrix('actual_sum', fy_slots, s + 1)
+    last_fy_actual = index.window_sum_matrix('actual_sum', fy_slots - 12, s - 11)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        yoy = np.where(last_fy_actual > 0, current_fy_actual / last_fy_actual * 100, np.nan)
+
+    diff = recent_rate - six_month_avg
+    comment = np.select(
+        [np.isnan(diff), diff > 5, diff < -5],
+        ["", "改善傾向 👍", "悪化傾向 👎"],
+        default="横ばい 😐"
+    )
+    return {
+        "present": present, "recent_rate": recent_rate, "fy_avg": fy_avg, "six_month_avg": six_month_avg,
+        "profit_share": profit_share, "yoy": yoy, "comment": comment,
+    }
+
+
+def _as_of_trends(index: MonthlyWindowIndex, s: np.ndarray) -> Dict[str, np.ndarray]:
+    """各スナップショット時点の線形トレンドの傾き・最新月平均乖離・直近3ヶ月変動係数"""
+    rates = index.point_matrix('rate_first')
+    mask = ~np.isnan(rates)
+    y = np.where(mask, rates, 0.0)
+    x = np.where(mask, np.cumsum(mask, axis=1) - 1, 0).astype(float)
+
+    # 月方向の累積和をスナップショット月で切り出す（x はデータのある月の通し番号なので前方一致で使える）
+    n = np.cumsum(mask, axis=1)[:, s].astype(float)
+    sx = np.cumsum(x, axis=1)[:, s]
+    sy = np.cumsum(y, axis=1)[:, s]
+    sxx = np.cumsum(x * x, axis=1)[:, s]
+    sxy = np.cumsum(x * y, axis=1)[:, s]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(n >= 2, (n * sxy - sx * sy) / (n * sxx - sx * sx), np.nan)
+
+    zeros = np.zeros_like(s)
+    eligible = index.window_sum_matrix('rate_count', zeros, s + 1) >= 3
+
+    # 各スナップショット時点で最後にデータがある月の値
+    last_slot = np.maximum.accumulate(np.where(mask, np.arange(rates.shape[1]), -1), axis=1)[:, s]
+    latest = np.where(last_slot >= 0, np.take_along_axis(rates, np.maximum(last_slot, 0), axis=1), np.nan)
+    deviation = latest - _window_mean(index, zeros, s + 1)
+
+    count = index.window_sum_matrix('rate_count', s - 2, s + 1).sum(axis=0)
+    total = index.window_sum_matrix('rate_sum', s - 2, s + 1).sum(axis=0)
+    sqtotal = index.window_sum_matrix('rate_sqsum', s - 2, s + 1).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(sqtotal - total * total / count, 0) / (count - 1))
+        cv = np.where(count > 1, std / mean * 100, np.nan)
+
+    return {
+        "slope": np.where(eligible, slope, np.nan),
+        "deviation": np.where(eligible, deviation, np.nan),
+        "cv": cv,
+    }
+
+
+def _counts(present: np.ndarray, condition: np.ndarray) -> np.ndarray:
+    return (present & condition).sum(axis=0).astype(float)
+
+
+def _overall_mean(summary: Dict[str, np.ndarray]) -> np.ndarray:
+    """直近月達成率の全診療科平均（欠損は除く）"""
+    rates = np.where(summary["present"], summary["recent_rate"], np.nan)
+    count = (~np.isnan(rates)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, np.nansum(rates, axis=0) / count, np.nan)
+
+
+# バックフィル用の中間データ（index・snapshots は入力として与える）
+BACKFILL_NODES: Dict[str, MetricNode] = {node.name: node for node in (
+    MetricNode("summary", ("index", "snapshots"), _as_of_values),
+    MetricNode("trends", ("index", "snapshots"), _as_of_trends),
+)}
+
+# メトリクス名 → 値（診療科 × スナップショットの行列、または全体指標のスナップショット別ベクトル）
+_SCORES = {"改善傾向 👍": 3.0, "悪化傾向 👎": 1.0}
+BACKFILL_VALUES = {
+    "総診療科数": lambda c: c["summary"]["present"].sum(axis=0).astype(float),
+    "目標達成診療科数": lambda c: _counts(c["summary"]["present"], c["summary"]["recent_rate"] >= 100),
+    "平均達成率": lambda c: _overall_mean(c["summary"]),
+    "高達成診療科数_110%以上": lambda c: _counts(c["summary"]["present"], c["summary"]["recent_rate"] >= 110),
+    "標準達成診療科数_100-110%": lambda c: _counts(
+        c["summary"]["present"], (c["summary"]["recent_rate"] >= 100) & (c["summary"]["recent_rate"] < 110)),
+    "未達成診療科数_100%未満": lambda c: _counts(c["summary"]["present"], c["summary"]["recent_rate"] < 100),
+    "直近月達成率": lambda c: c["summary"]["recent_rate"],
+    "今年度平均達成率": lambda c: c["summary"]["fy_avg"],
+    "過去6ヶ月平均達成率": lambda c: c["summary"]["six_month_avg"],
+    "全体比率": lambda c: c["summary"]["profit_share"],
+    "昨年度同期比": lambda c: c["summary"]["yoy"],
+    "傾向評価スコア": lambda c: np.vectorize(lambda comment: _SCORES.get(comment, 2.0), otypes=[float])(
+        c["summary"]["comment"]),
+    "直近3ヶ月変動係数": lambda c: c["trends"]["cv"],
+    "月次トレンド係数": lambda c: c["trends"]["slope"],
+    "最新月平均乖離": lambda c: c["trends"]["deviation"],
+}
+
+
+def backfill_metrics(chart_df: pd.DataFrame, start=None, end=None, metrics: Optional[List[str]] = None,
+                     app_name: str = "粗利分析") -> pd.DataFrame:
+    """
+    start〜end の各月末をスナップショット日として、その月までのデータで計算したメトリクスを縦に並べる。
+
+    各スナップショットの値は、chart_df をその月までに絞って今年度の判定に月末日を使い
+    export_metrics_csv（月次）を実行した結果と同じ定義。データが1件もない月はスナップショットにしない。
+
+    Args:
+        chart_df: 月次のチャートデータ
+        start, end: スナップショットにする最初・最後の月（None はデータの端まで）
+        metrics: 出力するメトリクス名（None は全メトリクス）
+
+    Returns:
+        スナップショット日 + メトリクス出力と同じ列のデータフレーム。
+        行はスナップショット日 → メトリクスの登録順 → 診療科順
+    """
+    specs = select_metrics(metrics)
+    if chart_df.empty:
+        return pd.DataFrame()
+
+    with stage("backfill", chart_df) as timing:
+        index = MonthlyWindowIndex(chart_df)
+        snapshots = _snapshot_slots(index, start, end)
+        if len(snapshots) == 0:
+            return timing.output(pd.DataFrame())
+        context = MetricContext({"index": index, "snapshots": snapshots}, nodes=BACKFILL_NODES)
+
+        snapshot_months = index.months[snapshots]
+        snapshot_dates = (snapshot_months + pd.offsets.MonthEnd(0)).date
+        first_label = index.months[0].strftime('%Y年%m月')
+        period_labels = np.array([f"{first_label}〜{month.strftime('%Y年%m月')}" for month in snapshot_months], dtype=object)
+        cv_labels = np.array([f"{(month - pd.DateOffset(months=2)).strftime('%Y年%m月')}以降" for month in snapshot_months], dtype=object)
+        departments = index.departments.to_numpy(dtype=object)
+        calculated_at = datetime.now().isoformat()
+
+        blocks = []
+        for metric_rank, spec in enumerate(specs):
+            values = np.asarray(BACKFILL_VALUES[spec.name](context))
+            if values.ndim == 1:
+                # 全体指標：スナップショットごとに1行
+                snap_idx = np.nonzero(~np.isnan(values))[0]
+                dept_names = np.full(len(snap_idx), "全体", dtype=object)
+                dept_rank = np.full(len(snap_idx), -1)
+                values = values[snap_idx]
+            else:
+                # その時点までにデータがある診療科だけ（傾向評価スコアは評価なしでも出力する）
+                present = context["summary"]["present"]
+                if spec.name != "傾向評価スコア":
+                    present = present & ~np.isnan(values)
+                dept_rank, snap_idx = np.nonzero(present)
+                dept_names = departments[dept_rank]
+                values = values[dept_rank, snap_idx]
+            if spec.digits is not None:
+                values = np.round(values, spec.digits)
+
+            is_cv = spec.name == "直近3ヶ月変動係数"
+            block = pd.DataFrame({
+                SNAPSHOT_COLUMN: snapshot_dates[snap_idx],
+                "診療科名": dept_names,
+                "メトリクス名": spec.name,
+                "値": values,
+                "単位": spec.unit,
+                "期間": (cv_labels if is_cv else period_labels)[snap_idx],
+                "期間タイプ": "3ヶ月" if is_cv else "月次",
+                "カテゴリ": spec.category,
+                "データ種別": spec.data_kind,
+                "計算日時": calculated_at,
+                "アプリ名": app_name,
+                "_snapshot": snap_idx,
+                "_metric": metric_rank,
+                "_department": dept_rank,
+            })
+            if spec.name == "傾向評価スコア":
+                block["備考"] = context["summary"]["comment"][dept_rank, snap_idx]
+            blocks.append(block)
+
+        backfill_df = pd.concat(blocks, ignore_index=True)
+        order = np.lexsort((backfill_df["_department"], backfill_df["_metric"], backfill_df["_snapshot"]))
+        columns = [SNAPSHOT_COLUMN] + METRIC_COLUMNS + (["備考"] if "備考" in backfill_df.columns else [])
+        return timing.output(backfill_df.iloc[order][columns].reset_index(drop=True))
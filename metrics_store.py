@@ -0,0 +1,236 @@
+# metrics_store.py
+"""
+粗利メトリクスの蓄積ストア
+export_metrics_csv / backfill_metrics の出力をスナップショット日ごとに SQLite ファイルへ保存し、
+診療科別の最新値やメトリクスの推移をパイプラインを再実行せずに引けるようにする
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import date, datetime
+from typing import List, Optional
+
+import pandas as pd
+
+from instrumentation import stage
+from metrics_backfill import SNAPSHOT_COLUMN
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = os.environ.get(
+    "GP_METRICS_STORE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".metrics_store", "metrics.sqlite3")
+)
+
+# メトリクス出力の列名 → テーブルの列名
+STORE_COLUMNS = {
+    SNAPSHOT_COLUMN: "snapshot_date",
+    "診療科名": "department",
+    "メトリクス名": "metric",
+    "値": "value",
+    "単位": "unit",
+    "期間": "period",
+    "期間タイプ": "period_type",
+    "カテゴリ": "category",
+    "データ種別": "data_kind",
+    "計算日時": "calculated_at",
+    "アプリ名": "app_name",
+    "備考": "note",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    snapshot_date TEXT NOT NULL,
+    department    TEXT NOT NULL,
+    metric        TEXT NOT NULL,
+    value         REAL,
+    unit          TEXT,
+    period        TEXT NOT NULL,
+    period_type   TEXT NOT NULL,
+    category      TEXT,
+    data_kind     TEXT,
+    calculated_at TEXT,
+    app_name      TEXT,
+    note          TEXT,
+    PRIMARY KEY (snapshot_date, metric, period_type, department)
+);
+CREATE INDEX IF NOT EXISTS idx_metrics_department
+    ON metrics (department, metric, period_type, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_metrics_series
+    ON metrics (metric, period_type, snapshot_date);
+"""
+
+
+def _snapshot_text(value) -> str:
+    """スナップショット日を 'YYYY-MM-DD' に揃える"""
+    if isinstance(value, str):
+        value = pd.Timestamp(value)
+    if isinstance(value, (datetime, pd.Timestamp)):
+        value = value.date()
+    if not isinstance(value, date):
+        raise ValueError(f"スナップショット日を解釈できません: {value!r}")
+    return value.isoformat()
+
+
+def _sql_value(value):
+    """NaN / pandas の欠損を NULL に、numpy の数値を Python の数値に変換"""
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value is pd.NA:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+    return value
+
+
+class MetricsStore:
+    """
+    メトリクスの SQLite ストア。
+
+    1行は（スナップショット日, メトリクス名, 期間タイプ, 診療科名）で一意。
+    同じスナップショット日のメトリクスを再保存すると、その（メトリクス名, 期間タイプ）の行を
+    まとめて置き換える（データの期間が変わった古い行や、再計算で消えた診療科の行が残らない）。
+    接続は操作ごとに開くため、複数スレッド・複数プロセスから使ってよい。
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    # --- 公開API ---
+
+    def append(self, metrics_df: pd.DataFrame, snapshot_date=None) -> int:
+        """
+        メトリクス出力を保存する。
+
+        Args:
+            metrics_df: export_metrics_csv または backfill_metrics の出力
+            snapshot_date: スナップショット日。metrics_df にスナップショット日列がある場合は不要で、
+                どちらもなければ計算日時の日付を使う
+
+        Returns:
+            保存した行数
+        """
+        if metrics_df is None or metrics_df.empty:
+            return 0
+
+        with stage("store", metrics_df):
+            df = metrics_df.copy()
+            if snapshot_date is not None:
+                df[SNAPSHOT_COLUMN] = snapshot_date
+            elif SNAPSHOT_COLUMN not in df.columns:
+                df[SNAPSHOT_COLUMN] = pd.to_datetime(df["計算日時"]).dt.date
+            df[SNAPSHOT_COLUMN] = [_snapshot_text(value) for value in df[SNAPSHOT_COLUMN]]
+            for column in STORE_COLUMNS:
+                if column not in df.columns:
+                    df[column] = None
+
+            columns = list(STORE_COLUMNS.values())
+            rows = [
+                tuple(_sql_value(value) for value in row)
+                for row in df[list(STORE_COLUMNS)].itertuples(index=False, name=None)
+            ]
+            slices = df[[SNAPSHOT_COLUMN, "メトリクス名", "期間タイプ"]].drop_duplicates()
+
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    "DELETE FROM metrics WHERE snapshot_date = ? AND metric = ? AND period_type = ?",
+                    slices.itertuples(index=False, name=None)
+                )
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    rows
+                )
+            logger.debug(f"メトリクスストアに保存: {len(rows)}行（{slices[SNAPSHOT_COLUMN].nunique()}時点）")
+            return len(rows)
+
+    def latest_per_department(self, metric: Optional[str] = None, period_type: Optional[str] = None) -> pd.DataFrame:
+        """
+        診療科 × メトリクス × 期間タイプごとに、最新のスナップショット日の値を返す。
+
+        Args:
+            metric: メトリクス名で絞り込む（None は全メトリクス）
+            period_type: 期間タイプで絞り込む（None は全期間タイプ）
+        """
+        conditions, params = self._filters(metric=metric, period_type=period_type)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+            SELECT m.* FROM metrics AS m
+            JOIN (
+                SELECT department, metric, period_type, MAX(snapshot_date) AS snapshot_date
+                FROM metrics {where}
+                GROUP BY department, metric, period_type
+            ) AS latest USING (department, metric, period_type, snapshot_date)
+            ORDER BY m.metric, m.period_type, m.department
+        """
+        return self._query(query, params)
+
+    def metric_series(self, metric: str, department: Optional[str] = None,
+                      period_type: Optional[str] = None) -> pd.DataFrame:
+        """
+        メトリクスのスナップショット日ごとの推移を返す（診療科 → スナップショット日の順）。
+
+        Args:
+            metric: メトリクス名
+            department: 診療科名で絞り込む（None は全診療科。全体指標は「全体」）
+            period_type: 期間タイプで絞り込む（None は全期間タイプ）
+        """
+        conditions, params = self._filters(metric=metric, department=department, period_type=period_type)
+        query = f"""
+            SELECT * FROM metrics WHERE {' AND '.join(conditions)}
+            ORDER BY department, period_type, snapshot_date, period
+        """
+        return self._query(query, params)
+
+    def snapshot_dates(self) -> List[date]:
+        """保存済みのスナップショット日（昇順）"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT DISTINCT snapshot_date FROM metrics ORDER BY snapshot_date").fetchall()
+        return [date.fromisoformat(row[0]) for row in rows]
+
+    # --- 内部処理 ---
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        with self._lock:
+            if not self._initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                self._initialized = True
+        return conn
+
+    @staticmethod
+    def _filters(**filters):
+        conditions = [f"{column} = ?" for column, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+        return conditions, params
+
+    def _query(self, query: str, params: list) -> pd.DataFrame:
+        """クエリ結果をメトリクス出力と同じ列名のデータフレームで返す"""
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(query, conn, params=params)
+        df = df.rename(columns={column: label for label, column in STORE_COLUMNS.items()})
+        df[SNAPSHOT_COLUMN] = pd.to_datetime(df[SNAPSHOT_COLUMN]).dt.date
+        if df["備考"].isna().all():
+            df = df.drop(columns="備考")
+        return df
+
+
+_default_store: Optional[MetricsStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_metrics_store() -> MetricsStore:
+    """プロセス共通のメトリクスストア（GP_METRICS_STORE で保存先を変更できる）"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = MetricsStore()
+        return _default_store
@@ -0,0 +1,261 @@
+# parse_cache.py
+"""
+アップロードファイルの読み込み結果キャッシュ
+ファイル内容のハッシュをキーに、正規化済みのデータフレームを
+メモリ（LRU）とローカルのParquetファイルに保存する
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "GP_PARSE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".parse_cache")
+)
+
+# キャッシュの形式のバージョン（キーに含める）。読み込み関数（load_data・classify_headers・数値変換など）の
+# 出力が変わったら上げる。古いバージョンのファイルは使われなくなり、ディスクの件数上限で順に削除される
+CACHE_VERSION = 1
+
+
+def file_content_hash(file) -> str:
+    """アップロードファイルの内容の SHA-256 ハッシュ"""
+    if hasattr(file, "getvalue"):
+        data = file.getvalue()
+    else:
+        position = file.tell()
+        file.seek(0)
+        data = file.read()
+        file.seek(position)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _encode_label(label) -> list:
+    """列名を JSON で保存できる形に変換"""
+    if isinstance(label, pd.Timestamp):
+        return ["timestamp", label.isoformat()]
+    if isinstance(label, (int, float)) and not isinstance(label, bool):
+        return ["number", label]
+    return ["str", str(label)]
+
+
+def _decode_label(encoded: list):
+    """_encode_label の逆変換"""
+    kind, value = encoded
+    if kind == "timestamp":
+        return pd.Timestamp(value)
+    return value
+
+
+def _to_parquet_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Parquet に保存できない型の混在した列を文字列列に変換（欠損はそのまま）"""
+    import pyarrow as pa
+
+    df = df.copy()
+    df.columns = [f"c{i}" for i in range(df.shape[1])]
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+class ParseCache:
+    """
+    読み込み結果のキャッシュ。
+
+    メモリ上には最近使った max_entries 件を保持し、それ以外は cache_dir の
+    Parquetファイルから復元する。キャッシュから返すデータフレームは常にコピーで、
+    呼び出し側が変更してもキャッシュには影響しない。
+    """
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR, max_entries: int = 16, max_disk_entries: int = 64):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, List[Optional[pd.DataFrame]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- 公開API ---
+
+    def load(self, file, loader: Callable, *args, **kwargs) -> Any:
+        """
+        loader(file, *args, **kwargs) の結果をキャッシュ経由で返す。
+        loader はデータフレーム、None、またはそれらのタプルを返す関数。
+        """
+        key = self.make_key(file, loader, *args, **kwargs)
+        cached = self.get(key)
+        if cached is not None:
+            logger.debug(f"読み込みキャッシュヒット: {getattr(file, 'name', '')}")
+            return cached
+
+        if hasattr(file, "seek"):
+            file.seek(0)
+        result = loader(file, *args, **kwargs)
+        if self._is_cacheable(result):
+            self.put(key, result)
+        return result
+
+    def make_key(self, file, loader: Callable, *args, **kwargs) -> str:
+        """ファイル内容・拡張子・読み込み関数・引数とキャッシュのバージョンからキーを作る"""
+        extension = os.path.splitext(getattr(file, "name", ""))[1].lower()
+        params = json.dumps(
+            [CACHE_VERSION, loader.__name__, extension, list(args), sorted(kwargs.items())],
+            default=str, ensure_ascii=False
+        )
+        return hashlib.sha256((file_content_hash(file) + params).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Any:
+        """キャッシュから取得（なければ None）"""
+        with self._lock:
+            frames = self._memory.get(key)
+            if frames is not None:
+                self._memory.move_to_end(key)
+        if frames is None:
+            frames = self._read_disk(key)
+            if frames is None:
+                return None
+            self._remember(key, frames)
+        return self._unpack(self._copy_frames(frames))
+
+    def put(self, key: str, result: Any):
+        """キャッシュに保存（メモリとディスク）"""
+        frames = self._copy_frames(self._pack(result))
+        self._remember(key, frames)
+        self._write_disk(key, frames)
+
+    def clear(self):
+        """メモリ上のキャッシュを破棄"""
+        with self._lock:
+            self._memory.clear()
+
+    # --- 内部処理 ---
+
+    @staticmethod
+    def _is_cacheable(result) -> bool:
+        frames = result if isinstance(result, tuple) else (result,)
+        return any(isinstance(df, pd.DataFrame) for df in frames)
+
+    @staticmethod
+    def _copy_frames(frames: list) -> list:
+        return [df.copy() if isinstance(df, pd.DataFrame) else df for df in frames]
+
+    @staticmethod
+    def _pack(result) -> List[Optional[pd.DataFrame]]:
+        # タプルで返す読み込み関数は末尾に印を付けて区別する
+        return list(result) + ["tuple"] if isinstance(result, tuple) else [result]
+
+    @staticmethod
+    def _unpack(frames: list) -> Any:
+        if frames and isinstance(frames[-1], str):
+            return tuple(frames[:-1])
+        return frames[0]
+
+    def _remember(self, key: str, frames: list):
+        with self._lock:
+            self._memory[key] = frames
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _frame_path(self, key: str, position: int) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{position}.parquet")
+
+    def _write_disk(self, key: str, frames: list):
+        if not self.cache_dir:
+            return
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            manifest = []
+            for position, df in enumerate(frames):
+                if not isinstance(df, pd.DataFrame):
+                    manifest.append(df)
+                    continue
+                table = pa.Table.from_pandas(_to_parquet_safe(df), preserve_index=False)
+                columns = json.dumps([_encode_label(label) for label in df.columns], ensure_ascii=False)
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"gp_columns": columns.encode("utf-8")})
+                pq.write_table(table, self._frame_path(key, position))
+                manifest.append({"parquet": position})
+            # マニフェストは最後に書く（書き込み途中のエントリを読まないため）
+            with open(self._manifest_path(key), "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            self._prune_disk()
+        except Exception as e:
+            logger.warning(f"読み込みキャッシュのParquet保存に失敗しました: {e}")
+
+    def _read_disk(self, key: str) -> Optional[list]:
+        if not self.cache_dir or not os.path.exists(self._manifest_path(key)):
+            return None
+        try:
+            import pyarrow.parquet as pq
+
+            with open(self._manifest_path(key), encoding="utf-8") as f:
+                manifest = json.load(f)
+            frames = []
+            for entry in manifest:
+                if not isinstance(entry, dict):
+                    frames.append(entry)
+                    continue
+                table = pq.read_table(self._frame_path(key, entry["parquet"]))
+                columns = json.loads(table.schema.metadata[b"gp_columns"].decode("utf-8"))
+                df = table.to_pandas()
+                df.columns = [_decode_label(label) for label in columns]
+                frames.append(df)
+            os.utime(self._manifest_path(key))
+            return frames
+        except Exception as e:
+            logger.warning(f"読み込みキャッシュのParquet読み込みに失敗しました: {e}")
+            return None
+
+    def _prune_disk(self):
+        """古いエントリから削除して max_disk_entries 件に収める"""
+        manifests = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if name.endswith(".json")
+        ]
+        if len(manifests) <= self.max_disk_entries:
+            return
+        manifests.sort(key=os.path.getmtime)
+        for manifest in manifests[:len(manifests) - self.max_disk_entries]:
+            key = os.path.basename(manifest)[:-len(".json")]
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(key + "."):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+_default_cache: Optional[ParseCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_parse_cache() -> ParseCache:
+    """プロセス共通の読み込みキャッシュ"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ParseCache()
+        return _default_cache
+
+
+def cached_load(file, loader: Callable, *args, **kwargs) -> Any:
+    """プロセス共通キャッシュを使って loader(file, ...) を実行"""
+    if file is None:
+        return loader(file, *args, **kwargs)
+    return get_parse_cache().load(file, loader, *args, **kwargs)
@@ -0,0 +1,185 @@
+# result_cache.py
+"""
+処理結果のプロセス共通キャッシュ
+同じファイル（内容のハッシュ）・同じ設定の処理結果を全セッションで共有する。
+合計サイズの上限と有効期限（TTL）を持ち、上限を超えると最近使っていないものから破棄する。
+
+キャッシュした結果は複数のセッションが同じオブジェクトを参照するため、読み取り専用として扱うこと
+（変更が必要な場合はコピーしてから行う）。
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MB = float(os.environ.get("GP_RESULT_CACHE_MB", "512"))
+DEFAULT_TTL_SECONDS = float(os.environ.get("GP_RESULT_CACHE_TTL", str(12 * 60 * 60)))
+
+
+def estimate_size(value, _seen: Optional[set] = None) -> int:
+    """
+    オブジェクトのおおよそのメモリ量（バイト）。
+    データフレーム・配列・辞書・タプルと、属性（__dict__ / __slots__）をたどって合計する。
+    同じオブジェクトは1回だけ数える。
+    """
+    seen = set() if _seen is None else _seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(index=True, deep=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(item, seen) for item in value.values())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(item, seen) for item in value)
+
+    size = sys.getsizeof(value)
+    attributes = getattr(value, "__dict__", None)
+    if attributes is not None:
+        size += estimate_size(attributes, seen)
+    for name in getattr(type(value), "__slots__", ()):
+        if hasattr(value, name):
+            size += estimate_size(getattr(value, name), seen)
+    return size
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expires_at")
+
+    def __init__(self, value: Any, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResultCache:
+    """
+    サイズ上限と有効期限付きの LRU キャッシュ（スレッドセーフ）。
+
+    get_or_compute は同じキーの計算が同時に要求されても1回だけ計算し、
+    他の呼び出しはその結果を待って同じオブジェクトを受け取る。
+    """
+
+    def __init__(self, max_bytes: int = int(DEFAULT_MAX_MB * 1024 * 1024), ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # --- 公開API ---
+
+    def get(self, key: Hashable) -> Any:
+        """キャッシュから取得（ない・期限切れは None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def contains(self, key: Hashable) -> bool:
+        """キャッシュにあるか（期限切れは False。ヒット数・ミス数と使用順は変えない）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.expires_at > time.monotonic()
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> Any:
+        """
+        キャッシュに保存して value を返す。
+        1件で上限を超えるものは保存しない（呼び出し側はそのまま value を使える。保存されたかは contains で確認する）。
+        """
+        size = estimate_size(value) if size is None else size
+        if size > self.max_bytes:
+            logger.debug(f"結果キャッシュの上限を超えるため保存しません: {size / 1024 / 1024:.1f}MB")
+            return value
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, time.monotonic() + self.ttl_seconds)
+            self._total_bytes += size
+            self._evict()
+        return value
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """キャッシュにあればそれを、なければ compute() の結果を保存して返す（同じキーの計算は1回だけ）"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 待っている間に他のスレッドが計算を終えていればそれを使う
+            value = self.get(key)
+            if value is None:
+                value = self.put(key, compute())
+        with self._lock:
+            if self._key_locks.get(key) is key_lock and not key_lock.locked():
+                del self._key_locks[key]
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        """件数・合計サイズ（MB）・ヒット数・ミス数"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "mb": round(self._total_bytes / 1024 / 1024, 3),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    # --- 内部処理（呼び出し側でロック済み） ---
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry.expires_at <= now]:
+            self._remove(key)
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+
+_default_cache: Optional[ResultCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """プロセス共通の結果キャッシュ（GP_RESULT_CACHE_MB / GP_RESULT_CACHE_TTL で上限と有効期限を変更できる）"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
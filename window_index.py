@@ -0,0 +1,186 @@
+# window_index.py
+"""
+診療科 × 月の累積和インデックス
+任意の期間（開始月〜終了月）の合計・平均を O(1) で引けるようにする
+"""
+
+import pandas as pd
+import numpy as np
+from typing import Optional
+
+
+def month_ordinal(month) -> int:
+    """日付を月の通し番号（年 × 12 + 月 - 1）に変換"""
+    month = pd.Timestamp(month)
+    return month.year * 12 + month.month - 1
+
+
+class MonthlyWindowIndex:
+    """
+    chart_df から作る診療科 × 月の行列と、その月方向の累積和。
+
+    月軸はデータの最初の月から最後の月まで欠けなく並べ、欠損月は件数0として扱う。
+    期間の合計は 累積和[終了] - 累積和[開始] で求めるため、期間の長さや
+    問い合わせ回数に関係なく chart_df を再走査しない。
+    """
+
+    # 累積和を持つ項目
+    SUM_FIELDS = ("rate_sum", "rate_sqsum", "rate_count", "actual_sum")
+    # 月単位の値をそのまま持つ項目
+    POINT_FIELDS = ("rate_first", "actual_first", "target_first")
+
+    def __init__(self, chart_df: pd.DataFrame):
+        df = chart_df[['診療科', '月', '実績', '目標', '達成率']].copy()
+        df['月番号'] = df['月'].dt.year * 12 + df['月'].dt.month - 1
+        df['達成率2乗'] = df['達成率'] ** 2
+
+        grouped = df.groupby(['診療科', '月番号'], sort=True).agg(
+            rate_sum=('達成率', 'sum'),
+            rate_sqsum=('達成率2乗', 'sum'),
+            rate_count=('達成率', 'count'),
+            actual_sum=('実績', 'sum'),
+            rate_first=('達成率', 'first'),
+            actual_first=('実績', 'first'),
+            target_first=('目標', 'first'),
+        )
+
+        self.departments = grouped.index.get_level_values('診療科').unique()
+        first_ord = int(df['月番号'].min()) if len(df) else 0
+        last_ord = int(df['月番号'].max()) if len(df) else -1
+        self._first_ord = first_ord
+        self.months = pd.DatetimeIndex([
+            pd.Timestamp(year=o // 12, month=o % 12 + 1, day=1)
+            for o in range(first_ord, last_ord + 1)
+        ])
+        n_depts, n_months = len(self.departments), len(self.months)
+
+        rows = self.departments.get_indexer(grouped.index.get_level_values('診療科'))
+        cols = grouped.index.get_level_values('月番号').to_numpy() - first_ord
+
+        self._cumsum = {}
+        for field in self.SUM_FIELDS:
+            matrix = np.zeros((n_depts, n_months))
+            matrix[rows, cols] = grouped[field].to_numpy(dtype=float)
+            cumsum = np.zeros((n_depts, n_months + 1))
+            np.cumsum(matrix, axis=1, out=cumsum[:, 1:])
+            self._cumsum[field] = cumsum
+
+        self._point = {}
+        for field in self.POINT_FIELDS:
+            matrix = np.full((n_depts, n_months), np.nan)
+            matrix[rows, cols] = grouped[field].to_numpy(dtype=float)
+            self._point[field] = matrix
+
+    @property
+    def latest_month(self) -> Optional[pd.Timestamp]:
+        """データ上の最新月"""
+        return self.months[-1] if len(self.months) else None
+
+    def _slot(self, month, default: int) -> int:
+        """月を月軸上の位置に変換（None は default）"""
+        if month is None:
+            return default
+        return month_ordinal(month) - self._first_ord
+
+    def _bounds(self, start, end):
+        """開始月・終了月（両端含む）を累積和の添字 [lo, hi) に変換"""
+        n_months = len(self.months)
+        lo = min(max(self._slot(start, 0), 0), n_months)
+        hi = min(max(self._slot(end, n_months - 1) + 1, 0), n_months)
+        return lo, max(lo, hi)
+
+    def window_sum(self, field: str, start=None, end=None) -> pd.Series:
+        """期間内の合計（診療科別）。start / end は含む。None は端まで"""
+        lo, hi = self._bounds(start, end)
+        cumsum = self._cumsum[field]
+        return pd.Series(cumsum[:, hi] - cumsum[:, lo], index=self.departments)
+
+    def slots(self, months) -> np.ndarray:
+        """月（複数）を月軸上の位置に変換（範囲外もそのまま返す）"""
+        months = pd.DatetimeIndex(months)
+        return np.asarray(months.year * 12 + months.month - 1 - self._first_ord, dtype=np.int64)
+
+    def window_sum_matrix(self, field: str, lo, hi) -> np.ndarray:
+        """
+        複数の期間の合計を一度に求める（診療科 × 期間の行列）。
+        lo / hi は各期間の月軸上の位置で、期間は [lo, hi)。範囲外は月軸の端に丸める
+        """
+        n_months = len(self.months)
+        lo = np.clip(np.asarray(lo), 0, n_months)
+        hi = np.maximum(np.clip(np.asarray(hi), 0, n_months), lo)
+        cumsum = self._cumsum[field]
+        return cumsum[:, hi] - cumsum[:, lo]
+
+    def point_matrix(self, field: str) -> np.ndarray:
+        """月単位の値の行列（診療科 × 月、欠損は NaN）。読み取り専用として扱うこと"""
+        return self._point[field]
+
+    def window_mean(self, start=None, end=None) -> pd.Series:
+        """期間内の平均達成率（診療科別）。データがない診療科は NaN"""
+        count = self.window_sum('rate_count', start, end)
+        return (self.window_sum('rate_sum', start, end) / count).where(count > 0)
+
+    def window_actual(self, start=None, end=None) -> pd.Series:
+        """期間内の実績合計（診療科別）"""
+        return self.window_sum('actual_sum', start, end)
+
+    def pooled_rate_stats(self, start=None, end=None) -> dict:
+        """期間内の全診療科の達成率をまとめた件数・平均・標準偏差（不偏）"""
+        n = self.window_sum('rate_count', start, end).sum()
+        total = self.window_sum('rate_sum', start, end).sum()
+        sqtotal = self.window_sum('rate_sqsum', start, end).sum()
+        mean = total / n if n > 0 else np.nan
+        std = np.sqrt(max(sqtotal - total * total / n, 0) / (n - 1)) if n > 1 else np.nan
+        return {"count": int(n), "mean": mean, "std": std}
+
+    def value_at(self, field: str, month) -> pd.Series:
+        """指定月の値（診療科別）。月軸外は NaN"""
+        slot = self._slot(month, len(self.months) - 1)
+        if not 0 <= slot < len(self.months):
+            return pd.Series(np.nan, index=self.departments)
+        return pd.Series(self._point[field][:, slot], index=self.departments)
+
+    def linear_trend(self, start=None, end=None) -> pd.DataFrame:
+        """
+        期間内の達成率の線形トレンド（診療科別）を一括で最小二乗計算する。
+
+        x は各診療科でデータのある月だけを数えた通し番号（0, 1, 2, ...）で、
+        欠損月は詰める（np.polyfit(range(len(group)), group['達成率'], 1) と同じ）。
+
+        Returns:
+            診療科を添字に、傾き（slope）・切片（intercept）・決定係数（r2）・件数（count）を持つデータフレーム。
+            データが2点未満の診療科は NaN、達成率が一定の診療科の r2 は NaN
+        """
+        lo, hi = self._bounds(start, end)
+        rates = self._point['rate_first'][:, lo:hi]
+        mask = ~np.isnan(rates)
+        y = np.where(mask, rates, 0.0)
+        x = np.where(mask, np.cumsum(mask, axis=1) - 1, 0).astype(float)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n = mask.sum(axis=1).astype(float)
+            x_mean = x.sum(axis=1) / n
+            y_mean = y.sum(axis=1) / n
+            # 平均を引いてから積和を取る（大きな値での桁落ちを避ける）
+            dx = np.where(mask, x - x_mean[:, None], 0.0)
+            dy = np.where(mask, y - y_mean[:, None], 0.0)
+            sxx = (dx * dx).sum(axis=1)
+            sxy = (dx * dy).sum(axis=1)
+            syy = (dy * dy).sum(axis=1)
+
+            slope = np.where(n >= 2, sxy / sxx, np.nan)
+            intercept = np.where(n >= 2, y_mean - slope * x_mean, np.nan)
+            r2 = np.where((n >= 2) & (syy > 0), (sxy * sxy) / (sxx * syy), np.nan)
+
+        return pd.DataFrame(
+            {"slope": slope, "intercept": intercept, "r2": r2, "count": n.astype(int)},
+            index=self.departments
+        )
+
+    def latest_value(self, field: str) -> pd.Series:
+        """診療科ごとに最後にデータがある月の値"""
+        matrix = self._point[field]
+        has_value = ~np.isnan(matrix)
+        last_slot = matrix.shape[1] - 1 - np.argmax(has_value[:, ::-1], axis=1)
+        values = matrix[np.arange(len(matrix)), last_slot] if matrix.shape[1] else np.full(len(matrix), np.nan)
+        return pd.Series(values, index=self.departments)